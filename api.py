@@ -1,16 +1,37 @@
 import logging
-import requests
+import concurrent.futures
+import copy
 import json
 import random
+import threading
 import time
 import os.path as osp
 from pathlib import Path
 from getpass import getpass
 
-from filters import Filter
-from downloader import download_scenes
+from filters import Filter, shardArgs
+from cache import DiskCache
+from throttle import RateLimiter, ConcurrencyController
+from downloader import DownloadPool, new_session, max_threads, max_segments
+from metrics import size_buckets
+from lazyimport import lazy_import
+from broker import SessionBroker, API_KEY_TTL
+
+requests = lazy_import('requests')
 
 M2M_ENDPOINT = 'https://m2m.cr.usgs.gov/api/api/json/{}/'
+CONFIG_PATH = '~/.config/m2m_api'
+CACHE_TTL = 24 * 3600
+POLL_MIN_SECONDS = 2.
+POLL_MAX_SECONDS = 60.
+POLL_FACTOR = 1.5
+BATCH_SIZE = 1000
+BATCH_WORKERS = 4
+GROUP_WORKERS = 4
+REQUEST_RATE = 5.
+REQUEST_BURST = 10
+LOGIN_ENDPOINTS = ('login', 'login-token')
+AUTH_ERROR_CODES = ('AUTH_KEY_INVALID',)
 logging.getLogger('requests').setLevel(logging.WARNING)
 
 class M2MError(Exception):
@@ -19,108 +40,207 @@ class M2MError(Exception):
     """
     pass
 
+class M2MAuthError(M2MError):
+    """
+    Raised when the API key of an M2M is not valid anymore.
+    """
+    pass
+
 class M2M(object):
-    """M2M EarthExplorer API."""
+    """M2M EarthExplorer API.
+
+    The API key of every login is cached in the config directory and reused by the next M2M
+    objects of the same user until it expires, and an expired key is replaced logging in again
+    when a request is rejected. With lazyLogin=True, the credentials are taken from the
+    arguments or the config file without prompting and nothing is requested until the first
+    request, which suits short-lived batch tasks:
+
+        m2m = M2M(username, token=token, lazyLogin=True)
+    """
 
-    def __init__(self, username=None, password=None, token=None, version="stable"):
+    def __init__(self, username=None, password=None, token=None, version="stable", cache_ttl=CACHE_TTL,
+                 searchCache=None, searchTTL={}, batchSize=BATCH_SIZE, batchWorkers=BATCH_WORKERS,
+                 requestRate=REQUEST_RATE, requestBurst=REQUEST_BURST, rateLimiter=None,
+                 maxDownloads=max_threads, adaptiveDownloads=True, postProcessor=None, poolOptions={},
+                 journal=None, metrics=None, lazyLogin=False, cacheApiKey=True, broker=None):
         self.serviceUrl = M2M_ENDPOINT.format(version)
         self.apiKey = None
-        self.authenticate(username, password, token)
-        allDatasets = self.sendRequest('dataset-search')
-        self.datasetNames = [dataset['datasetAlias'] for dataset in allDatasets]
-        self.permissions = self.sendRequest('permissions')
+        self.apiKeyExpires = None
+        if broker is None and cacheApiKey:
+            broker = SessionBroker(str(config_dir() / 'keys'))
+        self.broker = broker
+        self.loginLock = threading.RLock()
+        self.maxDownloads = maxDownloads
+        self.sessionLock = threading.Lock()
+        self._session = None
+        if rateLimiter is None and requestRate is not None:
+            rateLimiter = RateLimiter(requestRate, requestBurst)
+        self.rateLimiter = rateLimiter
+        self.postProcessor = postProcessor
+        self.poolOptions = poolOptions
+        self.journal = journal
+        self.metrics = metrics
+        self.downloadController = None
+        if adaptiveDownloads:
+            self.downloadController = ConcurrencyController(maximum=maxDownloads)
+        self.cache = DiskCache(config_dir() / 'cache', cache_ttl)
+        self.searchCache = searchCache
+        self.searchTTL = searchTTL
+        self.batchSize = batchSize
+        self.batchWorkers = batchWorkers
+        self._datasetNames = None
+        self._datasetIndex = None
+        self._permissions = None
+        if lazyLogin:
+            self.username, self._password, self._token = get_credentials(username, password, token, interactive=False)
+        else:
+            self.authenticate(username, password, token)
+
+    @property
+    def session(self):
+        if self._session is None:
+            with self.sessionLock:
+                if self._session is None:
+                    self._session = new_session(self.maxDownloads)
+        return self._session
+
+    @property
+    def datasetNames(self):
+        if self._datasetNames is None:
+            allDatasets = self.cachedRequest('dataset-search')
+            self._datasetNames = [dataset['datasetAlias'] for dataset in allDatasets]
+            self._datasetIndex = frozenset(self._datasetNames)
+        return self._datasetNames
+
+    def checkDataset(self, datasetName):
+        if self._datasetIndex is None:
+            self.datasetNames
+        if datasetName not in self._datasetIndex:
+            raise M2MError("Dataset {} not one of the available datasets {}".format(datasetName,self.datasetNames))
+
+    @property
+    def permissions(self):
+        if self._permissions is None:
+            self._permissions = self.cachedRequest('permissions')
+        return self._permissions
+
+    def cachedRequest(self, endpoint, data={}):
+        key = [self.serviceUrl, self.username, endpoint, data]
+        output = self.cache.get(key)
+        if output is None:
+            output = self.sendRequest(endpoint, data)
+            self.cache.set(key, output)
+        return output
+
+    def invalidateCache(self):
+        self.cache.invalidate()
+        self._datasetNames = None
+        self._datasetIndex = None
+        self._permissions = None
 
     def authenticate(self, username, password, token):
-        config_path = '~/.config/m2m_api'
-        config_path = Path(osp.expandvars(config_path)).expanduser().resolve()
-        config_file = config_path / 'config.json'
-        try:
-            config = json.load(open(config_file))
-        except:
-            config_path.mkdir(parents=True, exist_ok=True)
-            config = {} 
-        
-        self.username = username
-        if self.username is None:
-            self.username = config.get('username')
-            if self.username is None:
-                username = input("Enter your username (or email): ")
-                self.username = username
-                config['username'] = username
-            
-        if password != None:
-            self.login(password)
-        elif token != None:
-            config = {
-                'username': username,
-                'token': token
-            }
-            json.dump(config, open(config_file, 'w'), indent=4, separators=(',', ': '))
-            self.loginToken(token)
-        else:
-            token = config.get('token')
-            if token is None:
-                option = None
-                while option not in ["p", "P", "t", "T"]:
-                    option = input("Want to use password (p) or token (t)? ")
-                if option in ["p", "P"]:
-                    password = getpass()
-                    self.login(password)
-                else:
-                    token = input('Enter your token: ')
-                    config = {
-                        'username': username,
-                        'token': token
-                    }
-                    json.dump(config, open(config_file, 'w'), indent=4, separators=(',', ': '))
-                    self.loginToken(token)
+        self.username, self._password, self._token = get_credentials(username, password, token)
+        self.ensureLogin()
+
+    def apiKeyValid(self):
+        margin = self.broker.margin if self.broker is not None else 0
+        return self.apiKey is not None and (self.apiKeyExpires is None or time.time() < self.apiKeyExpires - margin)
+
+    def ensureLogin(self):
+        """
+        Get an API key if there is none or it is about to expire, from the broker if any.
+        """
+        with self.loginLock:
+            if self.apiKeyValid():
+                return
+            if self.broker is not None:
+                self.apiKey, self.apiKeyExpires = self.broker.acquire(self.serviceUrl, self.username, self.requestApiKey)
             else:
-                self.loginToken(token)
+                self.apiKey, self.apiKeyExpires = self.requestApiKey(), time.time() + API_KEY_TTL
+
+    def requestApiKey(self):
+        if self._password is not None:
+            return self.sendRequest('login', {'username': self.username, 'password': self._password})
+        if self._token is None:
+            raise M2MError('password or token not provided')
+        return self.sendRequest('login-token', {'username': self.username, 'token': self._token})
+
+    def expireApiKey(self, apiKey):
+        """
+        Forget an API key rejected by the service, unless another thread already replaced it.
+        """
+        with self.loginLock:
+            if self.apiKey == apiKey:
+                self.apiKey = None
+                if self.broker is not None:
+                    self.broker.invalidate(self.serviceUrl, self.username, apiKey)
 
     def sendRequest(self, endpoint, data={}, max_retries=5):
+        if endpoint in LOGIN_ENDPOINTS:
+            return self.postRequest(endpoint, data, max_retries)
+        if not self.apiKeyValid():
+            self.ensureLogin()
+        apiKey = self.apiKey
+        try:
+            return self.postRequest(endpoint, data, max_retries, apiKey)
+        except M2MAuthError as e:
+            if self._password is None and self._token is None:
+                raise
+            logging.warning('M2M.sendRequest - API key rejected ({}), logging in again'.format(e))
+            self.expireApiKey(apiKey)
+            self.ensureLogin()
+            return self.postRequest(endpoint, data, max_retries, self.apiKey)
+
+    def postRequest(self, endpoint, data={}, max_retries=5, apiKey=None):
         url = osp.join(self.serviceUrl, endpoint)
         logging.info('sendRequest - url = {}'.format(url))
         json_data = json.dumps(data)
-        if self.apiKey == None:
-            response = retry_connect(url, json_data, max_retries=max_retries)
-        else:
-            headers = {'X-Auth-Token': self.apiKey}   
-            response = retry_connect(url, json_data, headers=headers, max_retries=max_retries)
-        if response == None:
-            raise M2MError("No output from service")
-        status = response.status_code 
+        if self.metrics is not None:
+            start = time.monotonic()
+            self.metrics.gauge('m2m_requests_in_flight', 1)
+            self.metrics.observe('m2m_request_bytes', len(json_data), buckets=size_buckets, endpoint=endpoint)
         try:
-            output = json.loads(response.text)
-        except:
-            output = response.text
-        if status != 200:
-            if isinstance(output,dict):
-                msg = "{} - {} - {}".format(status,output['errorCode'],output['errorMessage'])
-            else:
-                msg = "{} - {}".format(status,output)
-            raise M2MError(msg)
-        else:
-            if isinstance(output,dict): 
-                if output['data'] is None and output['errorCode'] is not None and endpoint != 'logout':
-                    msg = "{} - {}".format(output['errorCode'],output['errorMessage'])
-                    raise M2MError(msg)
+            if apiKey == None:
+                response = retry_connect(url, json_data, max_retries=max_retries, session=self.session, rateLimiter=self.rateLimiter,
+                                         metrics=self.metrics)
             else:
-                msg = "{} - {}".format(status,output)
-                raise M2MError(msg)
-        response.close()
-        return output['data']
+                headers = {'X-Auth-Token': apiKey}
+                response = retry_connect(url, json_data, headers=headers, max_retries=max_retries, session=self.session,
+                                         rateLimiter=self.rateLimiter, metrics=self.metrics)
+            if response == None:
+                raise M2MError("No output from service")
+            if self.metrics is not None:
+                self.metrics.observe('m2m_response_bytes', len(response.content), buckets=size_buckets, endpoint=endpoint)
+            output = parse_response(endpoint, response.status_code, response.text)
+            response.close()
+        except Exception:
+            if self.metrics is not None:
+                self.metrics.increment('m2m_errors', endpoint=endpoint)
+            raise
+        finally:
+            if self.metrics is not None:
+                self.metrics.gauge('m2m_requests_in_flight', -1)
+                self.metrics.observe('m2m_request_seconds', time.monotonic() - start, endpoint=endpoint)
+        return output
 
     def login(self, password=None):
         if password is None:
             raise M2MError('password not provided')
         loginParameters = {'username': self.username, 'password': password}
-        self.apiKey = self.sendRequest('login', loginParameters)
+        self.setApiKey(self.sendRequest('login', loginParameters))
 
     def loginToken(self, token=None):
         if token is None: 
             raise M2MError('token not provided')
         loginParameters = {'username': self.username, 'token': token}
-        self.apiKey = self.sendRequest('login-token', loginParameters)
+        self.setApiKey(self.sendRequest('login-token', loginParameters))
+
+    def setApiKey(self, apiKey):
+        with self.loginLock:
+            if self.broker is not None:
+                self.apiKey, self.apiKeyExpires = self.broker.store(self.serviceUrl, self.username, apiKey)
+            else:
+                self.apiKey, self.apiKeyExpires = apiKey, time.time() + API_KEY_TTL
 
     def searchDatasets(self, **args):
         args['processList'] = ['datasetName','acquisitionFilter','spatialFilter']
@@ -130,28 +250,157 @@ class M2M(object):
     def datasetFilters(self, **args):
         args['processList'] = ['datasetName']
         params = Filter(args)
-        return self.sendRequest('dataset-filters', params)
+        return self.cachedRequest('dataset-filters', params)
 
-    def searchScenes(self, datasetName, **args):
-        if datasetName not in self.datasetNames:
-            raise M2MError("Dataset {} not one of the available datasets {}".format(datasetName,self.datasetNames))
-        args['datasetName'] = datasetName
-        if 'metadataInfo' in args and len(args['metadataInfo']):
-            args['datasetFilters'] = self.datasetFilters(**args)
-        args['processList'] = ['datasetName','sceneFilter','maxResults']
-        params = Filter(args)
-        scenes = self.sendRequest('scene-search', params)
+    def searchScenes(self, datasetName, timeShards=1, spaceShards=1, **args):
+        if timeShards != 1 or spaceShards != 1:
+            return self.searchShards(datasetName, timeShards, spaceShards, **args)
+        params = self.sceneSearchParams(datasetName, **args)
+        if self.searchCache is not None:
+            scenes = self.cachedSearch(datasetName, params)
+        else:
+            scenes = self.sendRequest('scene-search', params)
         if scenes['totalHits'] > scenes['recordsReturned']:
             logging.warning('M2M.searchScenes - more hits {} than returned records {}, consider increasing maxResults parameter.'.format(scenes['totalHits'],
                                                                                                                                         scenes['recordsReturned']))
         return scenes
 
+    def cachedSearch(self, datasetName, params):
+        """Search scenes using searchCache, with the TTL from searchTTL for the dataset if defined.
+
+        When the acquisition end date is today, the cache key does not depend on the end date and
+        an expired complete result is refreshed requesting only the scenes since its last end date.
+        """
+        ttl = self.searchTTL.get(datasetName)
+        today = time.strftime('%Y-%m-%d')
+        acquisitionFilter = params.get('sceneFilter', {}).get('acquisitionFilter', {})
+        incremental = acquisitionFilter.get('end') == today
+        keyParams = copy.deepcopy(params)
+        if incremental:
+            keyParams['sceneFilter']['acquisitionFilter']['end'] = 'today'
+        key = [self.serviceUrl, 'scene-search', keyParams]
+        cached = self.searchCache.get(key, ttl=ttl)
+        if cached is not None:
+            return cached['scenes']
+        entry = self.searchCache.getEntry(key)
+        if incremental and entry is not None and entry[1]['scenes']['totalHits'] == entry[1]['scenes']['recordsReturned']:
+            cached = entry[1]
+            tailParams = copy.deepcopy(params)
+            tailParams['sceneFilter']['acquisitionFilter']['start'] = cached['end']
+            tail = self.sendRequest('scene-search', tailParams)
+            results = {scene['entityId']: scene for scene in cached['scenes']['results']}
+            results.update({scene['entityId']: scene for scene in tail['results']})
+            maxResults = params.get('maxResults')
+            if tail['totalHits'] == tail['recordsReturned'] and (maxResults is None or len(results) <= maxResults):
+                logging.info('M2M.cachedSearch - refreshed {} scenes since {}'.format(tail['recordsReturned'], cached['end']))
+                scenes = dict(cached['scenes'], results=list(results.values()),
+                              recordsReturned=len(results), totalHits=len(results))
+                self.searchCache.set(key, {'end': today, 'scenes': scenes})
+                return scenes
+        scenes = self.sendRequest('scene-search', params)
+        self.searchCache.set(key, {'end': acquisitionFilter.get('end'), 'scenes': scenes})
+        return scenes
+
+    def searchShards(self, datasetName, timeShards=1, spaceShards=1, max_workers=max_threads, **args):
+        """Search scenes splitting the acquisition dates in timeShards ranges and the boundingBox in
+        spaceShards tiles (an integer of longitude tiles or a tuple of longitude and latitude tiles).
+
+        The shards are requested concurrently and the results are merged removing duplicated entityIds.
+        maxResults applies to every shard.
+        """
+        self.checkDataset(datasetName)
+        if 'metadataInfo' in args and len(args['metadataInfo']):
+            args['datasetFilters'] = self.datasetFilters(datasetName=datasetName)
+        shards = shardArgs(args, timeShards, spaceShards)
+        logging.info('M2M.searchShards - searching {} shards'.format(len(shards)))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(max_workers, len(shards))) as executor:
+            shardScenes = list(executor.map(lambda shard: self.sendRequest('scene-search', self.sceneSearchParams(datasetName, **shard)), shards))
+        results = {}
+        totalHits = 0
+        complete = True
+        for scenes in shardScenes:
+            totalHits += scenes['totalHits']
+            complete = complete and scenes['totalHits'] == scenes['recordsReturned']
+            for scene in scenes['results']:
+                if scene['entityId'] in results:
+                    totalHits -= 1
+                else:
+                    results[scene['entityId']] = scene
+        if complete:
+            totalHits = len(results)
+        else:
+            logging.warning('M2M.searchShards - more hits {} than returned records {}, consider increasing maxResults parameter.'.format(totalHits,len(results)))
+        return {
+            'results': list(results.values()),
+            'recordsReturned': len(results),
+            'totalHits': totalHits,
+            'startingNumber': 1,
+            'nextRecord': None
+        }
+
+    def iterScenes(self, datasetName, pageSize=1000, prefetch=True, **args):
+        """Generator over all the scenes of a search, requesting pages of pageSize scenes.
+
+        If maxResults is specified, at most maxResults scenes are yielded. If prefetch is True,
+        the next page is requested in the background while the current one is consumed.
+        """
+        maxResults = args.pop('maxResults', None)
+        params = self.sceneSearchParams(datasetName, **args)
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=1) if prefetch else None
+
+        def request_page(startingNumber, yielded):
+            if maxResults is not None and yielded >= maxResults:
+                return None
+            page = dict(params, startingNumber=startingNumber, maxResults=pageSize)
+            if maxResults is not None:
+                page['maxResults'] = min(pageSize, maxResults - yielded)
+            return self.sendRequest('scene-search', page)
+
+        try:
+            startingNumber, yielded = 1, 0
+            scenes = request_page(startingNumber, yielded)
+            while scenes is not None and scenes['recordsReturned'] > 0:
+                startingNumber = scenes.get('nextRecord') or startingNumber + scenes['recordsReturned']
+                yielded += scenes['recordsReturned']
+                last = yielded >= scenes['totalHits']
+                if executor is not None and not last:
+                    nextScenes = executor.submit(request_page, startingNumber, yielded)
+                for scene in scenes['results']:
+                    yield scene
+                if last:
+                    break
+                if executor is not None:
+                    scenes = nextScenes.result()
+                else:
+                    scenes = request_page(startingNumber, yielded)
+        finally:
+            if executor is not None:
+                executor.shutdown(wait=False)
+
+    def searchTable(self, datasetName, fields=[], pageSize=1000, **args):
+        """Search scenes page by page into a compact results.SceneTable (requires the numpy package).
+
+        Takes the same parameters as iterScenes, fields are other scene keys stored as columns.
+        """
+        from results import SceneTable
+        return SceneTable.fromScenes(self.iterScenes(datasetName, pageSize=pageSize, **args), fields)
+
+    def sceneSearchParams(self, datasetName, **args):
+        self.checkDataset(datasetName)
+        args['datasetName'] = datasetName
+        if 'metadataInfo' in args and len(args['metadataInfo']) and 'datasetFilters' not in args:
+            args['datasetFilters'] = self.datasetFilters(**args)
+        args['processList'] = ['datasetName','sceneFilter','maxResults','startingNumber']
+        return Filter(args)
+
     def sceneListAdd(self, listId, datasetName, **args):
         args['listId'] = listId
-        if datasetName not in self.datasetNames:
-            raise M2MError("Dataset {} not one of the available datasets {}".format(datasetName,self.datasetNames))
+        self.checkDataset(datasetName)
         args['datasetName'] = datasetName
-        self.sendRequest('scene-list-add', args)
+        if len(args.get('entityIds', [])) > self.batchSize:
+            self.batchRequest('scene-list-add', args, 'entityIds')
+        else:
+            self.sendRequest('scene-list-add', args)
     
     def sceneListGet(self, listId, **args):
         args['listId'] = listId
@@ -162,18 +411,33 @@ class M2M(object):
         self.sendRequest('scene-list-remove', args)
 
     def downloadOptions(self, datasetName, filterOptions={}, **args):
-        if datasetName not in self.datasetNames:
-            raise M2MError("Dataset {} not one of the available datasets {}".format(datasetName,self.datasetNames))
+        self.checkDataset(datasetName)
         args['datasetName'] = datasetName
-        downloadOptions = self.sendRequest('download-options', args)
+        if len(args.get('entityIds', [])) > self.batchSize:
+            downloadOptions = self.batchRequest('download-options', args, 'entityIds')
+        else:
+            downloadOptions = self.sendRequest('download-options', args)
         filteredOptions = apply_filter(downloadOptions, filterOptions)
         return filteredOptions
             
     def downloadRequest(self, downloadList, label='m2m-api_download'):
         params = {'downloads': downloadList,
                 'label': label}
+        if len(downloadList) > self.batchSize:
+            return self.batchRequest('download-request', params, 'downloads')
         return self.sendRequest('download-request', params)
 
+    def batchRequest(self, endpoint, params, batchKey):
+        """Send a request splitting the list params[batchKey] in batches of batchSize elements,
+        with batchWorkers batches in flight, and merge the outputs of all batches.
+        """
+        items = params[batchKey]
+        batches = [dict(params, **{batchKey: items[k:k+self.batchSize]}) for k in range(0, len(items), self.batchSize)]
+        logging.info('M2M.batchRequest - {} with {} elements in {} batches'.format(endpoint, len(items), len(batches)))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.batchWorkers) as executor:
+            outputs = list(executor.map(lambda batch: self.sendRequest(endpoint, batch), batches))
+        return merge_outputs(outputs)
+
     def downloadRetrieve(self, label='m2m-api_download'):
         params = {'label': label}
         return self.sendRequest('download-retrieve', params)
@@ -190,72 +454,390 @@ class M2M(object):
 
     def retrieveScenes(self, datasetName, scenes, filterOptions={}, label='m2m-api_download'):
         entityIds = [scene['entityId'] for scene in scenes['results']]
-        self.sceneListAdd(label, datasetName, entityIds=entityIds)
         downloadMeta = {}
+        labels = []
+        try:
+            with self.downloadPool(downloadMeta, len(entityIds)) as pool:
+                self.orderScenes(datasetName, entityIds, pool, downloadMeta, filterOptions, label, labels=labels)
+        except Exception:
+            self.removeOrders(labels)
+            raise
+        self.finishOrders(label, labels)
+        return downloadMeta
+
+    def retrieveBatch(self, groups, filterOptions={}, label='m2m-api_download', groupWorkers=GROUP_WORKERS):
+        """Retrieve scenes from several datasets in one job.
+
+        The scene list, download options and download request phases of up to groupWorkers groups
+        run concurrently, every group with its own order labelled label_k, and all the downloads
+        share one download pool, so maxDownloads and the adaptive concurrency apply to the whole
+        job. A scene in several groups of the same dataset is ordered only once.
+
+        :param groups: list of tuples (datasetName, scenes) with scenes as returned by searchScenes
+        :return: dictionary with metadata from all scenes, with the datasetName of every scene
+        """
+        orders = []
+        ordered = set()
+        for datasetName, scenes in groups:
+            self.checkDataset(datasetName)
+            entityIds = []
+            for scene in scenes['results']:
+                if (datasetName, scene['entityId']) not in ordered:
+                    ordered.add((datasetName, scene['entityId']))
+                    entityIds.append(scene['entityId'])
+            if len(entityIds):
+                orders.append(('{}_{}'.format(label, len(orders)), datasetName, entityIds))
+        logging.info('M2M.retrieveBatch - retrieving {} scenes from {} datasets in {} orders'.format(
+            len(ordered), len(set(order[1] for order in orders)), len(orders)))
+        downloadMeta = {}
+        if not len(orders):
+            return downloadMeta
+        errors = []
+        groupLabels = {lb: [] for lb, datasetName, entityIds in orders}
+        with self.downloadPool(downloadMeta, len(ordered)) as pool:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=min(groupWorkers, len(orders))) as executor:
+                futures = {executor.submit(self.orderScenes, datasetName, entityIds, pool, downloadMeta, filterOptions, lb,
+                                           labels=groupLabels[lb]): lb
+                           for lb, datasetName, entityIds in orders}
+        for future,lb in futures.items():
+            if future.exception() is not None:
+                logging.error('M2M.retrieveBatch - order {} failed: {}'.format(lb, future.exception()))
+                errors.append(future.exception())
+                self.removeOrders(groupLabels[lb])
+            else:
+                self.finishOrders(lb, future.result())
+        if len(errors):
+            raise errors[0]
+        return downloadMeta
+
+    def resume(self, label='m2m-api_download', filterOptions={}):
+        """Resume a job of retrieveScenes recorded in the journal after the process stopped.
+
+        The scenes of the job are ordered again, so M2M returns the products already ordered as
+        duplicates, and only the downloads not finished before or failed are downloaded.
+        """
+        if self.journal is None:
+            raise M2MError("resume needs a journal")
+        job = self.journal.getJob(label)
+        if job is None:
+            raise M2MError("Job {} not found in the journal".format(label))
+        downloadMeta = {idD: download['meta'] for idD,download in job['downloads'].items()}
+        if job['state'] == 'complete':
+            return downloadMeta
+        logging.info('M2M.resume - resuming job {} in state {}'.format(label, job['state']))
+        started = set(idD for idD,download in job['downloads'].items() if download['state'] == 'done')
+        labels = []
+        try:
+            with self.downloadPool(downloadMeta, len(job['entityIds']) - len(started)) as pool:
+                self.orderScenes(job['datasetName'], job['entityIds'], pool, downloadMeta, filterOptions, label, started, labels)
+        except Exception:
+            self.removeOrders(labels)
+            raise
+        self.finishOrders(label, labels)
+        return downloadMeta
+
+    def downloadPool(self, downloadMeta, nDownloads=None):
+        """Download pool of the M2M options. When there are fewer downloads than maxDownloads, the
+        spare threads download every scene in several byte ranges like in download_scenes.
+        """
+        segments = max_segments
+        if nDownloads is not None:
+            segments = max(max_segments, self.maxDownloads // max(nDownloads, 1))
+        options = dict({'segments': segments}, **self.poolOptions)
+        return DownloadPool(downloadMeta, self.session, max_workers=self.maxDownloads, controller=self.downloadController,
+                            postProcessor=self.postProcessor, metrics=self.metrics, **options)
+
+    def removeOrders(self, labels):
+        """Remove the orders of a job that failed, logging the orders not removed so the original
+        error is raised.
+        """
+        for lb in labels:
+            try:
+                self.downloadOrderRemove(lb)
+            except Exception as e:
+                logging.warning('M2M.removeOrders - not able to remove order {}: {}'.format(lb, e))
+
+    def finishOrders(self, label, labels):
+        """Remove the orders of a job and mark it complete in the journal if none of its downloads
+        failed, so it can be resumed otherwise.
+        """
+        for lb in labels:
+            self.downloadOrderRemove(lb)
+        if self.journal is not None:
+            job = self.journal.getJob(label)
+            failed = [idD for idD,download in job['downloads'].items() if download['state'] == 'failed'] if job else []
+            if len(failed):
+                logging.warning('M2M.finishOrders - {} downloads of job {} failed, resume it to retry them'.format(len(failed), label))
+            else:
+                self.journal.completeJob(label)
+
+    def orderScenes(self, datasetName, entityIds, pool, downloadMeta, filterOptions={}, label='m2m-api_download', started=None,
+                    labels=None):
+        """Order the download of a list of entityIds and submit every download to pool when available.
+
+        Returns the labels of the orders, which include the labels of products already ordered.
+        They are appended to labels when specified before being requested, so the caller can
+        remove the orders if this fails. The downloadIds in started are not submitted.
+        """
+        if self.journal is not None:
+            self.journal.startJob(label, datasetName, entityIds)
+        self.sceneListAdd(label, datasetName, entityIds=entityIds)
         if not len(filterOptions):
             filterOptions = {'downloadSystem': lambda x: x in ['dds', 'ls_zip'], 'available': lambda x: x}
-        labels = [label]
-        downloadOptions = self.downloadOptions(datasetName, filterOptions, listId=label, includeSecondaryFileGroups=False)
+        labels = [] if labels is None else labels
+        if len(entityIds) > self.batchSize:
+            downloadOptions = self.downloadOptions(datasetName, filterOptions, entityIds=entityIds, includeSecondaryFileGroups=False)
+        else:
+            downloadOptions = self.downloadOptions(datasetName, filterOptions, listId=label, includeSecondaryFileGroups=False)
         downloads = [{'entityId' : product['entityId'], 'productId' : product['id']} for product in downloadOptions]
         requestedDownloadsCount = len(downloads)
+        labels.append(label)
         if requestedDownloadsCount:
             logging.info('M2M.retrieveScenes - Requested downloads count={}'.format(requestedDownloadsCount))
-            requestResults = self.downloadRequest(downloads)
+            requestResults = self.downloadRequest(downloads, label)
             if len(requestResults['duplicateProducts']):
                 for product in requestResults['duplicateProducts'].values():
                     if product not in labels:
                         labels.append(product)
-            for label in labels:
-                downloadSearch = self.downloadSearch(label)
-                if downloadSearch is not None:
-                    for ds in downloadSearch:
-                        downloadMeta.update({str(ds['downloadId']): ds})
-            if requestResults['preparingDownloads'] != None and len(requestResults['preparingDownloads']) > 0:
-                downloadIds = []
-                for label in labels:
-                    requestResultsUpdated = self.downloadRetrieve(label)
-                    downloadUpdate = requestResultsUpdated['available'] + requestResultsUpdated['requested']
-                    download_scenes(downloadUpdate, downloadMeta)
-                    downloadIds += downloadMeta
-                while len(downloadIds) < requestedDownloadsCount:
-                    preparingDownloads = requestedDownloadsCount - len(downloadIds)
-                    logging.info('M2M.retrieveScenes - {} downloads are not available. Waiting 10 seconds...'.format(preparingDownloads))
-                    time.sleep(10)
-                    for label in labels:
-                        requestResultsUpdated = self.downloadRetrieve(label)
-                        downloadUpdate = requestResultsUpdated['available']
-                        download_scenes(downloadUpdate, downloadMeta)
-                        downloadIds += downloadUpdate
-            else:
-                download_scenes(requestResults['availableDownloads'], downloadMeta)
+            if self.journal is not None:
+                self.journal.jobRequested(label, labels, requestedDownloadsCount)
+            self.updateDownloadMeta(labels, downloadMeta, datasetName)
+            self.waitDownloads(labels, requestedDownloadsCount, requestResults['availableDownloads'], downloadMeta, pool,
+                               started=started, label=label)
         else:
             logging.info('M2M.retrieveScenes - No download options found')
+        return labels
+
+    def updateDownloadMeta(self, labels, downloadMeta, datasetName=None):
         for label in labels:
-            self.downloadOrderRemove(label)
-        return downloadMeta
+            downloadSearch = self.downloadSearch(label)
+            if downloadSearch is not None:
+                for ds in downloadSearch:
+                    meta = downloadMeta.setdefault(str(ds['downloadId']), {})
+                    meta.update(ds)
+                    if datasetName is not None:
+                        meta.setdefault('datasetName', datasetName)
+
+    def retrieveDownloads(self, labels):
+        downloads = []
+        for label in labels:
+            requestResultsUpdated = self.downloadRetrieve(label)
+            downloads += requestResultsUpdated['available'] + requestResultsUpdated['requested']
+        return downloads
+
+    def waitDownloads(self, labels, requestedDownloadsCount, availableDownloads, downloadMeta, pool,
+                      min_seconds=None, max_seconds=None, timeout=None, started=None, label=None):
+        """Submit every download to pool as soon as it becomes available.
+
+        Downloads are polled with download-retrieve using an exponential backoff with jitter between
+        min_seconds and max_seconds, which goes back to min_seconds when new downloads are available.
+        min_seconds and max_seconds default to POLL_MIN_SECONDS and POLL_MAX_SECONDS at call time.
+        Every downloadId is submitted only once, and the ones in started are not submitted.
+        """
+        min_seconds = POLL_MIN_SECONDS if min_seconds is None else min_seconds
+        max_seconds = POLL_MAX_SECONDS if max_seconds is None else max_seconds
+        started = set() if started is None else set(started)
+        if self.journal is not None and label is not None:
+            self.journal.recordDownloads(label, downloadMeta)
+        delay = min_seconds
+        start_time = time.time()
+        while True:
+            newDownloads = [download for download in availableDownloads
+                            if download.get('url') and str(download['downloadId']) not in started]
+            if any(str(download['downloadId']) not in downloadMeta for download in newDownloads):
+                self.updateDownloadMeta(labels, downloadMeta)
+                if self.journal is not None and label is not None:
+                    self.journal.recordDownloads(label, downloadMeta)
+            for download in newDownloads:
+                idD = str(download['downloadId'])
+                if idD in downloadMeta and idD not in started:
+                    started.add(idD)
+                    future = pool.submit(download)
+                    if self.metrics is not None:
+                        self.metrics.observe('download_preparation_seconds', time.time() - start_time)
+                    if self.journal is not None:
+                        self.journalDownload(idD, downloadMeta, future)
+            if len(started) >= requestedDownloadsCount:
+                break
+            if timeout is not None and time.time() - start_time > timeout:
+                raise M2MError('{} downloads not available after {} seconds'.format(requestedDownloadsCount - len(started), timeout))
+            delay = min_seconds if len(newDownloads) else min(delay * POLL_FACTOR, max_seconds)
+            sleep_seconds = delay * random.uniform(.5, 1.5)
+            logging.info('M2M.retrieveScenes - {} downloads are not available. Waiting {:.1f} seconds...'.format(requestedDownloadsCount - len(started), sleep_seconds))
+            time.sleep(sleep_seconds)
+            availableDownloads = self.retrieveDownloads(labels)
+
+    def journalDownload(self, idD, downloadMeta, future):
+        if future is None:
+            self.journal.downloadFinished(idD, downloadMeta[idD])
+        else:
+            self.journal.downloadStarted(idD, downloadMeta[idD])
+            future.add_done_callback(lambda f: self.journal.downloadFinished(idD, downloadMeta[idD], f.exception() is None))
 
     def logout(self):
         r = self.sendRequest('logout')
         if r != None:
             raise M2MError("Not able to logout")
+        if self.broker is not None:
+            self.broker.invalidate(self.serviceUrl, self.username, self.apiKey)
         self.apiKey = None
 
     def __exit__(self):
         self.logout()
 
-def retry_connect(url, json_data, headers={}, max_retries=5, sleep_seconds=2, timeout=600):
+def config_dir():
+    config_path = Path(osp.expandvars(CONFIG_PATH)).expanduser().resolve()
+    config_path.mkdir(parents=True, exist_ok=True)
+    return config_path
+
+def get_credentials(username, password, token, interactive=True):
+    config_file = config_dir() / 'config.json'
+    try:
+        config = json.load(open(config_file))
+    except:
+        config = {} 
+
+    if username is None:
+        username = config.get('username')
+        if username is None:
+            if not interactive:
+                raise M2MError('username not provided and not found in {}'.format(config_file))
+            username = input("Enter your username (or email): ")
+            config['username'] = username
+
+    if password != None:
+        return username, password, None
+    elif token != None:
+        config = {
+            'username': username,
+            'token': token
+        }
+        json.dump(config, open(config_file, 'w'), indent=4, separators=(',', ': '))
+        return username, None, token
+    else:
+        token = config.get('token')
+        if token is None:
+            if not interactive:
+                raise M2MError('password or token not provided and token not found in {}'.format(config_file))
+            option = None
+            while option not in ["p", "P", "t", "T"]:
+                option = input("Want to use password (p) or token (t)? ")
+            if option in ["p", "P"]:
+                password = getpass()
+                return username, password, None
+            else:
+                token = input('Enter your token: ')
+                config = {
+                    'username': username,
+                    'token': token
+                }
+                json.dump(config, open(config_file, 'w'), indent=4, separators=(',', ': '))
+        return username, None, token
+
+def parse_response(endpoint, status, text):
+    try:
+        output = json.loads(text)
+    except:
+        output = text
+    if isinstance(output,dict) and output.get('errorCode') in AUTH_ERROR_CODES:
+        raise M2MAuthError("{} - {} - {}".format(status,output['errorCode'],output['errorMessage']))
+    if status != 200:
+        if isinstance(output,dict):
+            msg = "{} - {} - {}".format(status,output['errorCode'],output['errorMessage'])
+        else:
+            msg = "{} - {}".format(status,output)
+        raise M2MError(msg)
+    else:
+        if isinstance(output,dict): 
+            if output['data'] is None and output['errorCode'] is not None and endpoint != 'logout':
+                msg = "{} - {}".format(output['errorCode'],output['errorMessage'])
+                raise M2MError(msg)
+        else:
+            msg = "{} - {}".format(status,output)
+            raise M2MError(msg)
+    return output['data']
+
+def retry_connect(url, json_data, headers={}, max_retries=5, sleep_seconds=2, timeout=600, session=requests, rateLimiter=None,
+                  metrics=None):
     retries = 0
+    endpoint = osp.basename(url.rstrip('/'))
     while retries < max_retries:
+        if rateLimiter is not None:
+            if metrics is not None:
+                start = time.monotonic()
+                rateLimiter.acquire()
+                metrics.observe('m2m_rate_limit_seconds', time.monotonic() - start)
+            else:
+                rateLimiter.acquire()
         try:
-            response = requests.post(url, json_data, headers=headers, timeout=timeout)
-            return response
+            response = session.post(url, json_data, headers=headers, timeout=timeout)
         except requests.exceptions.Timeout:
             retries += 1
-            logging.info('Connection Timeout - retry number {} of {}'.format(retries,max_retries))
-            sec = random.random() * sleep_seconds + 100.
+            if metrics is not None:
+                metrics.increment('m2m_retries', endpoint=endpoint, reason='timeout')
+            sec = 2 ** retries + random.random() * sleep_seconds
+            logging.info('Connection Timeout - retry number {} of {} in {:.1f} seconds'.format(retries,max_retries,sec))
+            if rateLimiter is not None:
+                rateLimiter.backoff(sec)
+            else:
+                time.sleep(sec)
+            continue
+        if not is_throttled(response):
+            return response
+        retries += 1
+        if metrics is not None:
+            metrics.increment('m2m_retries', endpoint=endpoint, reason='throttled')
+        try:
+            sec = float(response.headers.get('Retry-After'))
+        except (TypeError, ValueError):
+            sec = 2 ** retries + random.random() * sleep_seconds
+        logging.info('Request throttled with status {} - retry number {} of {} in {:.1f} seconds'.format(response.status_code,retries,max_retries,sec))
+        response.close()
+        if rateLimiter is not None:
+            rateLimiter.backoff(sec)
+        else:
             time.sleep(sec)
     raise M2MError("Maximum retries exceeded")
 
+def is_throttled(response):
+    if response.status_code in (429, 503):
+        return True
+    # scan the raw bytes first so normal responses are only parsed once, by parse_response
+    if b'RATE_LIMIT' not in response.content:
+        return False
+    try:
+        errorCode = response.json().get('errorCode') or ''
+    except (ValueError, AttributeError):
+        return False
+    return errorCode.startswith('RATE_LIMIT')
+
+def merge_outputs(outputs):
+    """Merge the outputs of the batches of a request. M2M returns fields like duplicateProducts
+    and newRecords as [] when empty and as dictionaries otherwise, so empty values are skipped.
+    """
+    result = None
+    for output in outputs:
+        if is_empty(output):
+            if result is None:
+                result = output
+            continue
+        if is_empty(result):
+            result = output
+        elif isinstance(output, list):
+            result = result + output
+        elif isinstance(output, dict):
+            result = dict(result)
+            for key,value in output.items():
+                result[key] = merge_outputs([result.get(key), value])
+        elif isinstance(output, (int, float)) and not isinstance(output, bool):
+            result = result + output
+        else:
+            result = output
+    return result
+
+def is_empty(output):
+    return output is None or (isinstance(output, (list, dict)) and not len(output))
+
 def apply_filter(elements, key_filters):
     result = []
     if elements != None:
@@ -0,0 +1,312 @@
+import asyncio
+import logging
+import json
+import random
+import os
+import os.path as osp
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+from filters import Filter
+from api import M2M_ENDPOINT, M2MError, get_credentials, parse_response, apply_filter
+from downloader import (ACQ_PATH, DownloadError, ensure_dir, remove, available_locally, read_checkpoint,
+                        write_checkpoint, sync_checkpoint, chunk_size, checkpoint_bytes, max_threads, total_max_retries)
+
+max_requests = 10
+
+class AsyncM2M(object):
+    """Asynchronous M2M EarthExplorer API.
+
+    It needs to be used as an asynchronous context manager, which opens the connection pool,
+    authenticates and loads the available datasets and permissions:
+
+        async with AsyncM2M() as m2m:
+            scenes = await m2m.searchScenes(**params)
+    """
+
+    def __init__(self, username=None, password=None, token=None, version="stable",
+                 max_requests=max_requests, max_downloads=max_threads):
+        if aiohttp is None:
+            raise M2MError("AsyncM2M requires the aiohttp package")
+        self.serviceUrl = M2M_ENDPOINT.format(version)
+        self.apiKey = None
+        self.session = None
+        self.credentials = (username, password, token)
+        self.requestSemaphore = asyncio.Semaphore(max_requests)
+        self.downloadSemaphore = asyncio.Semaphore(max_downloads)
+        self.connectionLimit = max_requests + max_downloads
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, *args):
+        try:
+            if self.apiKey is not None:
+                await self.logout()
+        finally:
+            await self.session.close()
+
+    async def connect(self):
+        connector = aiohttp.TCPConnector(limit=self.connectionLimit)
+        self.session = aiohttp.ClientSession(connector=connector)
+        await self.authenticate(*self.credentials)
+        allDatasets, self.permissions = await asyncio.gather(self.sendRequest('dataset-search'),
+                                                             self.sendRequest('permissions'))
+        self.datasetNames = [dataset['datasetAlias'] for dataset in allDatasets]
+        self.datasetIndex = frozenset(self.datasetNames)
+
+    async def authenticate(self, username, password, token):
+        self.username, password, token = get_credentials(username, password, token)
+        if password is not None:
+            await self.login(password)
+        else:
+            await self.loginToken(token)
+
+    async def sendRequest(self, endpoint, data={}, max_retries=5, sleep_seconds=2, timeout=600):
+        url = osp.join(self.serviceUrl, endpoint)
+        logging.info('sendRequest - url = {}'.format(url))
+        json_data = json.dumps(data)
+        headers = {}
+        if self.apiKey is not None:
+            headers = {'X-Auth-Token': self.apiKey}
+        retries = 0
+        while retries < max_retries:
+            try:
+                async with self.requestSemaphore:
+                    async with self.session.post(url, data=json_data, headers=headers,
+                                                 timeout=aiohttp.ClientTimeout(total=timeout)) as response:
+                        status = response.status
+                        text = await response.text()
+                return parse_response(endpoint, status, text)
+            except asyncio.TimeoutError:
+                retries += 1
+                logging.info('Connection Timeout - retry number {} of {}'.format(retries,max_retries))
+                await asyncio.sleep(random.random() * sleep_seconds + 100.)
+        raise M2MError("Maximum retries exceeded")
+
+    async def login(self, password=None):
+        if password is None:
+            raise M2MError('password not provided')
+        loginParameters = {'username': self.username, 'password': password}
+        self.apiKey = await self.sendRequest('login', loginParameters)
+
+    async def loginToken(self, token=None):
+        if token is None:
+            raise M2MError('token not provided')
+        loginParameters = {'username': self.username, 'token': token}
+        self.apiKey = await self.sendRequest('login-token', loginParameters)
+
+    def checkDataset(self, datasetName):
+        if datasetName not in self.datasetIndex:
+            raise M2MError("Dataset {} not one of the available datasets {}".format(datasetName,self.datasetNames))
+
+    async def datasetFilters(self, **args):
+        args['processList'] = ['datasetName']
+        params = Filter(args)
+        return await self.sendRequest('dataset-filters', params)
+
+    async def searchScenes(self, datasetName, **args):
+        self.checkDataset(datasetName)
+        args['datasetName'] = datasetName
+        if 'metadataInfo' in args and len(args['metadataInfo']):
+            args['datasetFilters'] = await self.datasetFilters(**args)
+        args['processList'] = ['datasetName','sceneFilter','maxResults']
+        params = Filter(args)
+        scenes = await self.sendRequest('scene-search', params)
+        if scenes['totalHits'] > scenes['recordsReturned']:
+            logging.warning('AsyncM2M.searchScenes - more hits {} than returned records {}, consider increasing maxResults parameter.'.format(scenes['totalHits'],
+                                                                                                                                             scenes['recordsReturned']))
+        return scenes
+
+    async def sceneListAdd(self, listId, datasetName, **args):
+        args['listId'] = listId
+        self.checkDataset(datasetName)
+        args['datasetName'] = datasetName
+        await self.sendRequest('scene-list-add', args)
+
+    async def downloadOptions(self, datasetName, filterOptions={}, **args):
+        self.checkDataset(datasetName)
+        args['datasetName'] = datasetName
+        downloadOptions = await self.sendRequest('download-options', args)
+        return apply_filter(downloadOptions, filterOptions)
+
+    async def downloadRequest(self, downloadList, label='m2m-api_download'):
+        params = {'downloads': downloadList,
+                  'label': label}
+        return await self.sendRequest('download-request', params)
+
+    async def downloadRetrieve(self, label='m2m-api_download'):
+        params = {'label': label}
+        return await self.sendRequest('download-retrieve', params)
+
+    async def downloadSearch(self, label=None):
+        if label is not None:
+            params = {'label': label}
+            return await self.sendRequest('download-search', params)
+        return await self.sendRequest('download-search')
+
+    async def downloadOrderRemove(self, label):
+        params = {'label': label}
+        await self.sendRequest('download-order-remove', params)
+
+    async def retrieveScenes(self, datasetName, scenes, filterOptions={}, label='m2m-api_download', poll_seconds=10):
+        entityIds = [scene['entityId'] for scene in scenes['results']]
+        await self.sceneListAdd(label, datasetName, entityIds=entityIds)
+        downloadMeta = {}
+        if not len(filterOptions):
+            filterOptions = {'downloadSystem': lambda x: x in ['dds', 'ls_zip'], 'available': lambda x: x}
+        labels = [label]
+        downloadOptions = await self.downloadOptions(datasetName, filterOptions, listId=label, includeSecondaryFileGroups=False)
+        downloads = [{'entityId' : product['entityId'], 'productId' : product['id']} for product in downloadOptions]
+        requestedDownloadsCount = len(downloads)
+        if requestedDownloadsCount:
+            logging.info('AsyncM2M.retrieveScenes - Requested downloads count={}'.format(requestedDownloadsCount))
+            requestResults = await self.downloadRequest(downloads, label)
+            for product in (requestResults['duplicateProducts'] or {}).values():
+                if product not in labels:
+                    labels.append(product)
+            for downloadSearch in await asyncio.gather(*[self.downloadSearch(lb) for lb in labels]):
+                for ds in downloadSearch or []:
+                    downloadMeta.update({str(ds['downloadId']): ds})
+            started = set()
+            tasks = []
+            while True:
+                for retrieved in await asyncio.gather(*[self.downloadRetrieve(lb) for lb in labels]):
+                    for download in retrieved['available'] + retrieved['requested']:
+                        idD = str(download['downloadId'])
+                        if download.get('url') and idD in downloadMeta and idD not in started:
+                            started.add(idD)
+                            tasks.append(asyncio.ensure_future(self.downloadScene(download, downloadMeta)))
+                if len(started) >= requestedDownloadsCount:
+                    break
+                logging.info('AsyncM2M.retrieveScenes - {} downloads are not available. Waiting {} seconds...'.format(requestedDownloadsCount - len(started), poll_seconds))
+                await asyncio.sleep(poll_seconds)
+            await asyncio.gather(*tasks)
+        else:
+            logging.info('AsyncM2M.retrieveScenes - No download options found')
+        await asyncio.gather(*[self.downloadOrderRemove(lb) for lb in labels])
+        return downloadMeta
+
+    async def downloadScene(self, download, downloadMeta):
+        idD = str(download['downloadId'])
+        local_path = osp.join(ACQ_PATH, downloadMeta[idD]['displayId']+'.tar')
+        downloadMeta[idD].update({'url': download['url'], 'local_path': local_path})
+        if await run_blocking(available_locally, local_path):
+            logging.info('AsyncM2M.downloadScene - file {} is locally available'.format(local_path))
+            return
+        async with self.downloadSemaphore:
+            await async_download_url(self.session, download['url'], local_path)
+
+    async def logout(self):
+        r = await self.sendRequest('logout')
+        if r != None:
+            raise M2MError("Not able to logout")
+        self.apiKey = None
+
+async def async_download_url(session, url, local_path, max_retries=total_max_retries, sleep_seconds=5, chunk_size=chunk_size):
+    """
+    Download a remote URL to the location local_path with retries using an aiohttp session.
+
+    The content is streamed into local_path + '.part' and resumed with HTTP Range requests
+    using the same .size checkpoint as downloader.download_url.
+
+    :param session: aiohttp client session
+    :param url: the remote URL
+    :param local_path: the path to the local file
+    :param max_retries: how many times we may retry to download the file
+    :param sleep_seconds: sleep seconds between retries
+    :param chunk_size: size in bytes of the buffer used to stream the content to disk
+    """
+    dname = osp.basename(local_path)
+    part_path = local_path + '.part'
+    info_path = local_path + '.size'
+    logging.info('async_download_url - {} - downloading {} as {}'.format(dname, url, local_path))
+    retries = max_retries
+    while True:
+        try:
+            content_size = await async_download_part(session, url, part_path, info_path, chunk_size)
+            break
+        except (aiohttp.ClientError, asyncio.TimeoutError, DownloadError) as e:
+            logging.warning('async_download_url - {} - download failed: {}'.format(dname, e))
+            if retries > 0:
+                retries -= 1
+                await asyncio.sleep(sleep_seconds)
+            else:
+                await run_blocking(remove, part_path)
+                await run_blocking(remove, info_path)
+                raise DownloadError('async_download_url - {} - failed to download file {}'.format(dname, url))
+    await run_blocking(os.replace, part_path, local_path)
+    await run_blocking(write_checkpoint, info_path, {'size': content_size, 'bytes': content_size})
+    logging.info('async_download_url - {} - success download'.format(dname))
+
+async def async_download_part(session, url, part_path, info_path, chunk_size=chunk_size):
+    """
+    Download or resume a remote URL into a partial file using the checkpoint in info_path.
+
+    The file operations run in the default executor so they do not stall the event loop, and
+    the checkpoint is stored every checkpoint_bytes like in downloader.write_stream.
+
+    :return: the size of the remote content
+    """
+    checkpoint = await run_blocking(read_checkpoint, info_path)
+    offset = checkpoint.get('bytes', 0)
+    validator = checkpoint.get('etag') or checkpoint.get('last_modified')
+    headers = {}
+    if offset > 0 and validator and 'segments' not in checkpoint and await run_blocking(osp.exists, part_path):
+        headers = {'Range': 'bytes={}-'.format(offset), 'If-Range': validator}
+    else:
+        offset = 0
+    async with session.get(url, headers=headers) as r:
+        r.raise_for_status()
+        if r.status == 206:
+            content_size = int(r.headers.get('Content-Range', '*/0').split('/')[-1])
+            if checkpoint.get('size') != content_size:
+                await run_blocking(write_checkpoint, info_path, {'size': content_size, 'bytes': 0})
+                raise DownloadError('async_download_url - remote size changed')
+        else:
+            content_size = int(r.headers.get('Content-Length', 0))
+            offset = 0
+        if content_size == 0:
+            raise DownloadError('async_download_url - content size is equal to 0')
+        checkpoint = {
+            'size': content_size,
+            'bytes': offset,
+            'etag': r.headers.get('ETag'),
+            'last_modified': r.headers.get('Last-Modified')
+        }
+        f = await run_blocking(open_part, part_path, offset)
+        try:
+            pending = 0
+            try:
+                async for chunk in r.content.iter_chunked(chunk_size):
+                    await run_blocking(f.write, chunk)
+                    pending += len(chunk)
+                    if pending >= checkpoint_bytes:
+                        checkpoint['bytes'] += pending
+                        pending = 0
+                        await run_blocking(sync_checkpoint, f, info_path, dict(checkpoint))
+            finally:
+                checkpoint['bytes'] += pending
+                await run_blocking(sync_checkpoint, f, info_path, checkpoint)
+            await run_blocking(f.truncate)
+        finally:
+            await run_blocking(f.close)
+    if await run_blocking(osp.getsize, part_path) != content_size:
+        await run_blocking(write_checkpoint, info_path, {'size': content_size, 'bytes': 0})
+        raise DownloadError('async_download_url - wrong file size')
+    return content_size
+
+def open_part(part_path, offset):
+    f = open(ensure_dir(part_path), 'r+b' if offset else 'wb')
+    f.seek(offset)
+    return f
+
+async def run_blocking(func, *args):
+    """
+    Run a blocking function in the default executor of the event loop.
+    """
+    return await asyncio.get_event_loop().run_in_executor(None, func, *args)
@@ -0,0 +1,126 @@
+import contextlib
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+import os.path as osp
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# seconds an API key is valid after login
+API_KEY_TTL = 2 * 3600
+# seconds before expiration when an API key is refreshed
+API_KEY_MARGIN = 300
+
+class SessionBroker(object):
+    """
+    Shares one API key per service URL and user among all the M2M objects of a node.
+
+    The API keys are cached in a directory, one file per user written atomically and readable
+    only by its owner. When there is no valid API key, a single process logs in while holding a
+    lock file (fcntl.flock, a process lock where not available) and the other processes waiting
+    for it reuse its API key, so hundreds of workers starting together send one login request.
+    API keys are refreshed margin seconds before they expire.
+    """
+
+    def __init__(self, directory, ttl=API_KEY_TTL, margin=API_KEY_MARGIN):
+        """
+        :param directory: directory of the cached API keys, shared by all the processes of the node
+        :param ttl: seconds an API key is valid after login
+        :param margin: seconds before expiration when an API key is not handed out anymore
+        """
+        self.directory = directory
+        self.ttl = ttl
+        self.margin = margin
+        self.threadLock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, serviceUrl, username):
+        name = hashlib.sha256('{} {}'.format(serviceUrl, username).encode()).hexdigest()[:32]
+        return osp.join(self.directory, name + '.json')
+
+    @contextlib.contextmanager
+    def lock(self, serviceUrl, username):
+        """
+        Exclusive lock of the API key of a user among the processes of the node.
+        """
+        if fcntl is None:
+            with self.threadLock:
+                yield
+            return
+        fd = os.open(self.path(serviceUrl, username) + '.lock', os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            os.close(fd)
+
+    def load(self, serviceUrl, username):
+        """
+        Cached API key of a user, if it is valid for at least margin seconds.
+
+        :return: tuple with the API key and its expiration time, None if there is no valid one
+        """
+        try:
+            with open(self.path(serviceUrl, username)) as f:
+                cached = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if cached.get('expires', 0) - self.margin < time.time():
+            return None
+        return cached.get('apiKey'), cached['expires']
+
+    def store(self, serviceUrl, username, apiKey, expires=None):
+        """
+        Cache the API key of a user.
+
+        :param expires: expiration time of the API key, ttl seconds from now by default
+        :return: tuple with the API key and its expiration time
+        """
+        path = self.path(serviceUrl, username)
+        expires = expires or time.time() + self.ttl
+        tmp_path = '{}.{}.{}.tmp'.format(path, os.getpid(), threading.get_ident())
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'apiKey': apiKey, 'expires': expires}, f)
+        os.replace(tmp_path, path)
+        return apiKey, expires
+
+    def acquire(self, serviceUrl, username, login):
+        """
+        Valid API key of a user, logging in only if no other process did it.
+
+        :param login: function without arguments sending the login request and returning the API key
+        :return: tuple with the API key and its expiration time
+        """
+        cached = self.load(serviceUrl, username)
+        if cached is not None:
+            return cached
+        with self.lock(serviceUrl, username):
+            cached = self.load(serviceUrl, username)
+            if cached is not None:
+                logging.info('SessionBroker.acquire - reusing API key of {} from another process'.format(username))
+                return cached
+            logging.info('SessionBroker.acquire - logging in {}'.format(username))
+            return self.store(serviceUrl, username, login())
+
+    def invalidate(self, serviceUrl, username, apiKey=None):
+        """
+        Remove the cached API key of a user, only if it is apiKey when specified, so a key
+        rejected by the service in one process does not discard a newer one from another.
+        """
+        path = self.path(serviceUrl, username)
+        with self.lock(serviceUrl, username):
+            try:
+                if apiKey is not None:
+                    with open(path) as f:
+                        if json.load(f).get('apiKey') != apiKey:
+                            return
+                os.remove(path)
+            except (OSError, ValueError):
+                pass
@@ -0,0 +1,145 @@
+import collections
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+import os.path as osp
+
+class MemoryCache(object):
+    """
+    In-memory least recently used cache with a time to live.
+    """
+
+    def __init__(self, maxsize=128, ttl=3600):
+        """
+        :param maxsize: maximum number of entries kept
+        :param ttl: seconds an entry is valid after being stored
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def getEntry(self, key):
+        """
+        Get the tuple (time, value) stored for a key regardless of its age, None if not stored.
+        """
+        with self.lock:
+            entry = self.entries.get(canonical(key))
+            if entry is not None:
+                self.entries.move_to_end(canonical(key))
+            return entry
+
+    def get(self, key, default=None, ttl=None):
+        """
+        Get the value for a key if stored and not expired, default otherwise.
+        """
+        return getValue(self, key, default, ttl)
+
+    def set(self, key, value):
+        """
+        Store a value for a key.
+        """
+        with self.lock:
+            self.entries[canonical(key)] = (time.time(), value)
+            self.entries.move_to_end(canonical(key))
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, key=None):
+        """
+        Remove the entry of a key, or all the entries if key is None.
+        """
+        with self.lock:
+            if key is None:
+                self.entries.clear()
+            else:
+                self.entries.pop(canonical(key), None)
+
+class DiskCache(object):
+    """
+    Persistent key-value cache storing JSON serializable values with a time to live.
+
+    Every entry is a JSON file in the cache directory named after the hash of its key.
+    """
+
+    def __init__(self, path, ttl):
+        """
+        :param path: directory where the entries are stored
+        :param ttl: seconds an entry is valid after being stored
+        """
+        self.path = str(path)
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(self.path, exist_ok=True)
+
+    def entryPath(self, key):
+        digest = hashlib.sha256(canonical(key).encode()).hexdigest()
+        return osp.join(self.path, digest + '.json')
+
+    def getEntry(self, key):
+        """
+        Get the tuple (time, value) stored for a key regardless of its age, None if not stored.
+        """
+        try:
+            with open(self.entryPath(key)) as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return entry['time'], entry['value']
+
+    def get(self, key, default=None, ttl=None):
+        """
+        Get the value for a key if stored and not expired, default otherwise.
+        """
+        return getValue(self, key, default, ttl)
+
+    def set(self, key, value):
+        """
+        Store a value for a key.
+        """
+        entry_path = self.entryPath(key)
+        tmp_path = '{}.{}.tmp'.format(entry_path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump({'time': time.time(), 'value': value}, f)
+        os.replace(tmp_path, entry_path)
+
+    def invalidate(self, key=None):
+        """
+        Remove the entry of a key, or all the entries if key is None.
+        """
+        if key is not None:
+            entry_paths = [self.entryPath(key)]
+        else:
+            entry_paths = [osp.join(self.path, name) for name in os.listdir(self.path) if name.endswith('.json')]
+        for entry_path in entry_paths:
+            try:
+                os.remove(entry_path)
+            except FileNotFoundError:
+                pass
+
+def getValue(cache, key, default=None, ttl=None):
+    """
+    Get the value for a key from a cache if stored and younger than ttl (cache ttl by default),
+    counting hits and misses.
+    """
+    if ttl is None:
+        ttl = cache.ttl
+    entry = cache.getEntry(key)
+    if entry is None or time.time() - entry[0] > ttl:
+        cache.misses += 1
+        return default
+    cache.hits += 1
+    logging.debug('{}.get - cache hit for {}'.format(type(cache).__name__, key))
+    return entry[1]
+
+def canonical(obj):
+    """
+    Canonical JSON representation of an object, independent of the order of dictionary keys.
+    """
+    return json.dumps(obj, sort_keys=True, separators=(',', ':'), default=str)
@@ -1,8 +1,11 @@
 import concurrent.futures
-import logging, time, subprocess, requests, random, os
-from six.moves.urllib import request as urequest
+import logging, time, random, os, json, threading, hashlib, tarfile, fnmatch
 import os.path as osp
 
+from lazyimport import lazy_import
+
+requests = lazy_import('requests')
+
 ACQ_PATH = './ingest'
 
 sleep_seconds = 5
@@ -10,8 +13,14 @@ total_max_retries = 3
 wget = 'wget'
 wget_options = ["--quiet", "--read-timeout=1", "--random-wait", "--progress=dot:giga", "--limit-rate=10m"]
 download_sleep_seconds = 3
+chunk_size = 1024 * 1024
+checkpoint_bytes = 64 * 1024 * 1024
+preallocate = True
+extract_filter = {'filter': 'data'} if hasattr(tarfile, 'data_filter') else {}
 
 max_threads = 10
+max_segments = 1
+min_segment_size = 32 * 1024 * 1024
 
 class DownloadError(Exception):
     """
@@ -19,91 +28,673 @@ class DownloadError(Exception):
     """
     pass
 
-def download_url(url, local_path, max_retries=total_max_retries, sleep_seconds=sleep_seconds):
+def download_url(url, local_path, max_retries=total_max_retries, sleep_seconds=sleep_seconds, chunk_size=chunk_size, segments=None, session=None,
+                 hashAlgorithm=None, checksum=None):
     """
     Download a remote URL to the location local_path with retries.
 
     On download, the file size is first obtained and stored.  When the download completes,
     the file size is compared to the stored file.  This prevents broken downloads from
-    contaminating the processing chain.
+    contaminating the processing chain. The content is streamed to disk in chunks, so
+    memory usage does not depend on the size of the remote file.
+
+    The content is written to local_path + '.part' and the .size sidecar is used as a
+    checkpoint of the bytes already written together with the ETag and Last-Modified
+    validators of the remote file. A failed download is resumed with an HTTP Range
+    request, and the partial file is discarded if the remote file has changed.
+
+    If segments is larger than 1 and the server accepts byte ranges, the file is split in
+    byte ranges downloaded concurrently and written in place into the partial file.
+
+    If hashAlgorithm is specified, the content is hashed while it is downloaded (segmented
+    downloads are disabled) and the digest is stored in the .size sidecar. If checksum is
+    also specified, a download with a different digest is discarded and retried.
 
     :param url: the remote URL
     :param local_path: the path to the local file
     :param max_retries: how many times we may retry to download the file
     :param sleep_seconds: sleep seconds between retries
+    :param chunk_size: size in bytes of the buffer used to stream the content to disk
+    :param segments: number of concurrent byte ranges, max_segments by default
+    :param session: requests session used to reuse connections, a new one by default
+    :param hashAlgorithm: hashlib algorithm used to hash the content, None to not hash it
+    :param checksum: expected hexadecimal digest of the content
+    :return: the size of the downloaded file
     """
+    if segments is None:
+        segments = max_segments
+    if hashAlgorithm is not None:
+        segments = 1
+    if session is None:
+        session = new_session(segments)
     dname = osp.basename(local_path)
+    part_path = local_path + '.part'
+    info_path = local_path + '.size'
     logging.info('download_url - {} - downloading {} as {}'.format(dname, url, local_path))
     sec = random.random() * download_sleep_seconds
     time.sleep(sec)
 
-    try:
-        r = requests.get(url, stream=True)
-        content_size = int(r.headers.get('content-length', 0))
+    retries = max_retries
+    while True:
+        try:
+            content_size, digest = None, None
+            if segments > 1:
+                content_size = download_segments(url, part_path, info_path, segments, chunk_size, session)
+            if content_size is None:
+                content_size, digest = download_part(url, part_path, info_path, chunk_size, session, hashAlgorithm)
+            check_digest(dname, digest, checksum, info_path)
+            break
+        except Exception as e:
+            logging.warning('download_url - {} - download failed: {}'.format(dname, e))
+            if retries > 0:
+                logging.info('download_url - {} - trying again with {} available retries'.format(dname, retries))
+                retries -= 1
+                time.sleep(sleep_seconds)
+            else:
+                logging.error('download_url - {} - no more retries available'.format(dname))
+                remove(part_path)
+                remove(info_path)
+                raise DownloadError('download_url - {} - failed to download file {}'.format(dname, url))
+
+    os.replace(part_path, local_path)
+    checkpoint = {'size': content_size, 'bytes': content_size}
+    if digest is not None:
+        checkpoint.update({'hashAlgorithm': hashAlgorithm, 'checksum': digest})
+    write_checkpoint(info_path, checkpoint)
+    logging.info('download_url - {} - success download'.format(dname))
+    return content_size
+
+def check_digest(dname, digest, checksum, info_path):
+    """
+    Compare a digest with the expected checksum, resetting the checkpoint if they differ.
+    """
+    if digest is not None and checksum is not None and digest.lower() != checksum.lower():
+        write_checkpoint(info_path, {'size': 0, 'bytes': 0})
+        raise DownloadError('download_url - {} - checksum {} different than expected {}'.format(dname, digest, checksum))
+
+def comparable_checksum(checksum, hashAlgorithm):
+    """
+    Checksum provided with a download if it can be compared to the digest of hashAlgorithm.
+
+    M2M does not tell which algorithm produced its checksums, so a checksum is only compared
+    when its length is the length of the hexadecimal digest of hashAlgorithm.
+
+    :return: the checksum, None if it cannot be compared
+    """
+    if checksum is None or hashAlgorithm is None:
+        return None
+    if len(checksum) != 2 * hashlib.new(hashAlgorithm).digest_size:
+        logging.info('download_url - checksum {} is not a {} digest, not compared'.format(checksum, hashAlgorithm))
+        return None
+    return checksum
+
+def download_part(url, part_path, info_path, chunk_size=chunk_size, session=requests, hashAlgorithm=None):
+    """
+    Download or resume a remote URL into a partial file using the checkpoint in info_path.
+
+    :param url: the remote URL
+    :param part_path: the path to the partial local file
+    :param info_path: the path to the checkpoint sidecar
+    :param chunk_size: size in bytes of the buffer used to stream the content to disk
+    :param session: requests session or module used for the request
+    :param hashAlgorithm: hashlib algorithm used to hash the content, None to not hash it
+    :return: tuple with the size of the remote content and its hexadecimal digest (None if not hashed)
+    """
+    dname = osp.basename(part_path)
+    checkpoint = read_checkpoint(info_path)
+    offset = checkpoint.get('bytes', 0)
+    validator = checkpoint.get('etag') or checkpoint.get('last_modified')
+    headers = {}
+    if offset > 0 and validator and 'segments' not in checkpoint and osp.exists(part_path):
+        headers = {'Range': 'bytes={}-'.format(offset), 'If-Range': validator}
+    else:
+        offset = 0
+
+    with session.get(url, headers=headers, stream=True) as r:
+        r.raise_for_status()
+        if r.status_code == 206:
+            content_size = int(r.headers.get('content-range', '*/0').split('/')[-1])
+            if checkpoint.get('size') != content_size:
+                write_checkpoint(info_path, {'size': content_size, 'bytes': 0})
+                raise DownloadError('download_url - {} - remote size changed'.format(dname))
+            logging.info('download_url - {} - resuming download from byte {}'.format(dname, offset))
+        else:
+            if offset > 0:
+                logging.info('download_url - {} - remote file changed, starting download again'.format(dname))
+            content_size = int(r.headers.get('content-length', 0))
+            offset = 0
         if content_size == 0:
-            logging.error('download_url - content size is equal to 0')
             raise DownloadError('download_url - content size is equal to 0')
-    except Exception as e:
-        if max_retries > 0:
-            logging.info('download_url - {} - trying again with {} available retries'.format(dname, max_retries))
-            time.sleep(sleep_seconds)
-            download_url(url, local_path, max_retries = max_retries - 1, sleep_seconds=sleep_seconds)
-        logging.error('download_url - {} - no more retries available'.format(dname))
-        raise DownloadError('download_url - {} - failed to find file {}'.format(dname, url))
-
-    remove(local_path)
-    logging.info('download_url - {} - starting download...'.format(dname))
-    '''
-    command=[wget,'-O',ensure_dir(local_path),url]
-    for opt in wget_options:
-        command.insert(1,opt)
-    logging.info(' '.join(command))
-    subprocess.call(' '.join(command),shell=True)
-    '''
-    with open(ensure_dir(local_path), 'wb') as f:
-        f.write(r.raw.read())
-
-    file_size = osp.getsize(local_path)
+        checkpoint = {
+            'size': content_size,
+            'bytes': offset,
+            'etag': r.headers.get('etag'),
+            'last_modified': r.headers.get('last-modified')
+        }
+        if offset == 0:
+            remove(part_path)
+            logging.info('download_url - {} - starting download...'.format(dname))
+        hasher = None
+        if hashAlgorithm is not None:
+            hasher = hashlib.new(hashAlgorithm)
+            if offset:
+                hash_prefix(hasher, part_path, offset, chunk_size)
+        with open(ensure_dir(part_path), 'r+b' if offset else 'wb') as f:
+            f.seek(offset)
+            write_stream(r, f, content_size, chunk_size, checkpoint=checkpoint, info_path=info_path, hasher=hasher)
+
+    file_size = osp.getsize(part_path)
     logging.info('download_url - {} - local file size {} remote content size {}'.format(dname, file_size, content_size))
-    if int(file_size) != int(content_size) and int(content_size) > 0:
-        logging.warning('download_url - {} - wrong file size, trying again, retries available {}'.format(dname, max_retries))
-        if max_retries > 0:
-            time.sleep(sleep_seconds)
-            download_url(url, local_path, content_size, max_retries = max_retries-1, sleep_seconds=sleep_seconds)
-        logging.error('download_url - {} - deleting local file, no more retries available'.format(dname))
-        os.remove(local_path)
-        raise DownloadError('download_url - {} - failed to download file {}'.format(dname, url))
-        
-    info_path = local_path + '.size'
-    open(ensure_dir(info_path), 'w').write(str(content_size))
-    logging.info('download_url - {} - success download'.format(dname))
+    if file_size != content_size:
+        write_checkpoint(info_path, {'size': content_size, 'bytes': 0})
+        raise DownloadError('download_url - {} - wrong file size'.format(dname))
+    return content_size, None if hasher is None else hasher.hexdigest()
 
-def download_scenes(downloads, downloadMeta):
+def hash_prefix(hasher, path, nbytes, chunk_size=chunk_size):
+    """
+    Update a hasher with the first nbytes of a file, used when a hashed download is resumed.
+    """
+    with open(path, 'rb') as f:
+        while nbytes > 0:
+            block = f.read(min(chunk_size, nbytes))
+            if not block:
+                break
+            hasher.update(block)
+            nbytes -= len(block)
+
+def download_extract(url, extract_path, members=None, max_retries=total_max_retries, sleep_seconds=sleep_seconds,
+                     chunk_size=chunk_size, session=None, hashAlgorithm=None, checksum=None):
+    """
+    Download a remote tar file extracting its members on the fly, so the tar file is never stored.
+
+    The stream is read sequentially by a streaming tarfile reader and only the members matching
+    the glob patterns in members are written into extract_path. The whole stream is hashed if
+    hashAlgorithm is specified and compared to checksum. When the extraction completes, the
+    result is stored in extract_path + '.done'. Retries start again from the beginning.
+
+    :param url: the remote URL
+    :param extract_path: the directory where the members are extracted
+    :param members: list of glob patterns of the members to extract (bands for instance '*_B4.TIF'), all by default
+    :param max_retries: how many times we may retry to download the file
+    :param sleep_seconds: sleep seconds between retries
+    :param chunk_size: size in bytes of the buffer used to read the stream
+    :param session: requests session used to reuse connections, a new one by default
+    :param hashAlgorithm: hashlib algorithm used to hash the content, None to not hash it
+    :param checksum: expected hexadecimal digest of the content
+    :return: dictionary with the size, the checksum and the extracted files
+    """
+    if session is None:
+        session = new_session(1)
+    dname = osp.basename(extract_path)
+    done_path = extract_path + '.done'
+    logging.info('download_extract - {} - downloading and extracting {} into {}'.format(dname, url, extract_path))
+    time.sleep(random.random() * download_sleep_seconds)
+    retries = max_retries
+    while True:
+        try:
+            with session.get(url, stream=True) as r:
+                r.raise_for_status()
+                content_size = int(r.headers.get('content-length', 0))
+                r.raw.decode_content = True
+                reader = HashingReader(r.raw, hashAlgorithm)
+                extracted = []
+                with tarfile.open(fileobj=reader, mode='r|*', bufsize=chunk_size) as tar:
+                    for member in tar:
+                        if member.isfile() and (members is None or any(fnmatch.fnmatch(osp.basename(member.name), pattern) for pattern in members)):
+                            tar.extract(member, extract_path, set_attrs=False, **extract_filter)
+                            extracted.append(osp.join(extract_path, member.name))
+                reader.drain(chunk_size)
+            if content_size and reader.nbytes != content_size:
+                raise DownloadError('download_extract - {} - wrong stream size {} instead of {}'.format(dname, reader.nbytes, content_size))
+            digest = reader.hexdigest()
+            if digest is not None and checksum is not None and digest.lower() != checksum.lower():
+                raise DownloadError('download_extract - {} - checksum {} different than expected {}'.format(dname, digest, checksum))
+            break
+        except Exception as e:
+            logging.warning('download_extract - {} - download failed: {}'.format(dname, e))
+            if retries > 0:
+                retries -= 1
+                time.sleep(sleep_seconds)
+            else:
+                raise DownloadError('download_extract - {} - failed to download file {}'.format(dname, url))
+    result = {'size': reader.nbytes, 'extracted': extracted}
+    if digest is not None:
+        result.update({'hashAlgorithm': hashAlgorithm, 'checksum': digest})
+    write_checkpoint(done_path, result)
+    logging.info('download_extract - {} - {} files extracted'.format(dname, len(extracted)))
+    return result
+
+class HashingReader(object):
+    """
+    File-like wrapper of a stream hashing and counting the bytes read.
+    """
+
+    def __init__(self, raw, hashAlgorithm=None):
+        self.raw = raw
+        self.hasher = hashlib.new(hashAlgorithm) if hashAlgorithm is not None else None
+        self.nbytes = 0
+
+    def read(self, size=-1):
+        data = self.raw.read(size)
+        self.nbytes += len(data)
+        if self.hasher is not None:
+            self.hasher.update(data)
+        return data
+
+    def drain(self, chunk_size=chunk_size):
+        while self.read(chunk_size):
+            pass
+
+    def hexdigest(self):
+        return None if self.hasher is None else self.hasher.hexdigest()
+
+def extracted_locally(extract_path):
+    """
+    Check if a scene has been completely extracted by download_extract.
+
+    :param extract_path: the extraction directory
+    :return: the stored result if available, None otherwise
+    """
+    result = read_checkpoint(extract_path + '.done')
+    if result and all(osp.exists(path) for path in result.get('extracted', [])):
+        return result
+    return None
+
+def download_scenes(downloads, downloadMeta, session=None, postProcessor=None, inventory=None, metrics=None):
     """
     Download all scenes using multithreading.
 
+    When there are fewer scenes than max_threads, the spare threads are used to download
+    every scene in several byte ranges.
+
     :param downloads: list of downloadable scenes
     :param downloadMeta: dictionary with metadata from all scenes
+    :param session: requests session shared by all the downloads, a new one by default
+    :param postProcessor: optional postprocess.PostProcessor processing every downloaded file
+    :param inventory: optional inventory.Inventory of the scenes available locally
+    :param metrics: optional metrics.Metrics recording the downloads
     """
     logging.info('download_scenes - downloading {} scenes'.format(len(downloads)))
-    with concurrent.futures.ThreadPoolExecutor(max_workers=max_threads) as executor:
-        futures = []
-        for download in downloads:
-            idD = str(download['downloadId'])
-            displayId = downloadMeta[idD]['displayId']
-            url = download['url']
+    segments = max(max_segments, max_threads // max(len(downloads), 1))
+    with DownloadPool(downloadMeta, session, segments=segments, postProcessor=postProcessor, inventory=inventory,
+                      metrics=metrics) as pool:
+        pool.submitAll(downloads)
+    logging.info('download_scenes - all download scenes finished')
+
+class DownloadPool(object):
+    """
+    Pool of threads downloading scenes as soon as they are submitted.
+    """
+
+    def __init__(self, downloadMeta, session=None, max_workers=max_threads, segments=max_segments, controller=None,
+                 postProcessor=None, hashAlgorithm=None, extract=False, members=None, inventory=None, metrics=None):
+        """
+        :param downloadMeta: dictionary with metadata from all scenes, updated with url and local_path
+        :param session: requests session shared by all the downloads, a new one by default
+        :param max_workers: maximum number of concurrent downloads
+        :param segments: number of concurrent byte ranges of every download
+        :param controller: optional throttle.ConcurrencyController adapting the concurrent downloads
+        :param postProcessor: optional postprocess.PostProcessor processing every downloaded file in
+            worker processes, its results are stored in downloadMeta under 'postprocess'
+        :param hashAlgorithm: hashlib algorithm used to hash the content while it is downloaded,
+            compared to the checksum of the download if provided by M2M with the length of its digests
+        :param extract: extract the tar files while they are downloaded into a directory named
+            displayId instead of storing them, see download_extract
+        :param members: list of glob patterns of the members to extract, all by default
+        :param inventory: optional inventory.Inventory used instead of the .size sidecars to know
+            the tar files available locally, updated with every downloaded file
+        :param metrics: optional metrics.Metrics recording queued and in flight downloads, their
+            duration, size, throughput and errors
+        """
+        self.downloadMeta = downloadMeta
+        self.session = new_session(max_workers) if session is None else session
+        self.segments = segments
+        self.controller = controller
+        self.postProcessor = postProcessor
+        self.hashAlgorithm = hashAlgorithm
+        self.extract = extract
+        self.members = members
+        self.inventory = inventory
+        self.metrics = metrics
+        self.localScenes = set()
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+        self.futures = []
+        self.processFutures = []
+        self.finished = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.wait()
+
+    def submitAll(self, downloads):
+        """
+        Submit a list of downloadable scenes, querying the inventory for the missing ones at once.
+
+        :param downloads: list of dictionaries with downloadId and url
+        :return: list of futures of the downloads, None for the ones locally available
+        """
+        if self.inventory is not None and not self.extract:
+            displayIds = [self.downloadMeta[str(download['downloadId'])]['displayId'] for download in downloads]
+            self.localScenes.update(set(displayIds) - set(self.inventory.missing(displayIds)))
+        return [self.submit(download) for download in downloads]
+
+    def submit(self, download):
+        """
+        Submit a downloadable scene, skipping it if it is locally available.
+
+        :param download: dictionary with downloadId and url
+        :return: the future of the download, None if locally available
+        """
+        idD = str(download['downloadId'])
+        displayId = self.downloadMeta[idD]['displayId']
+        url = download['url']
+        if self.extract:
+            local_path = osp.join(ACQ_PATH,displayId)
+            self.downloadMeta[idD].update({'url': url, 'local_path': local_path})
+            result = extracted_locally(local_path)
+            if result is not None:
+                logging.info('downloadScenes - scene {} is locally extracted'.format(local_path))
+                self.downloadMeta[idD].update(result)
+                return None
+        else:
             local_path = osp.join(ACQ_PATH,displayId+'.tar')
-            if available_locally(local_path):
+            self.downloadMeta[idD].update({'url': url, 'local_path': local_path})
+            if self.locallyAvailable(displayId, local_path):
                 logging.info('downloadScenes - file {} is locally available'.format(local_path))
+                return None
+        if self.metrics is not None:
+            self.metrics.gauge('downloads_queued', 1)
+        checksum = comparable_checksum(download.get('checksum'), self.hashAlgorithm)
+        future = self.executor.submit(self.download, idD, url, local_path, checksum)
+        self.futures.append(future)
+        future.add_done_callback(self.done)
+        if self.postProcessor is not None and not self.extract:
+            future.add_done_callback(lambda f: self.postprocess(f, idD, local_path))
+        return future
+
+    def locallyAvailable(self, displayId, local_path):
+        if self.inventory is None:
+            return available_locally(local_path)
+        return displayId in self.localScenes or self.inventory.available(displayId)
+
+    def postprocess(self, future, idD, local_path):
+        if future.exception() is not None:
+            return
+        processFuture = self.postProcessor.submit(local_path)
+        processFuture.add_done_callback(lambda f: self.processed(f, idD))
+        self.processFutures.append(processFuture)
+
+    def processed(self, future, idD):
+        if future.exception() is not None:
+            logging.error('download_scenes - post-processing of {} failed: {}'.format(idD, future.exception()))
+            self.downloadMeta[idD]['postprocess'] = {'error': str(future.exception())}
+        else:
+            self.downloadMeta[idD]['postprocess'] = future.result()
+
+    def download(self, idD, url, local_path, checksum=None):
+        if self.metrics is not None:
+            self.metrics.gauge('downloads_queued', -1)
+        if self.controller is not None:
+            self.controller.acquire()
+        if self.metrics is not None:
+            start = time.monotonic()
+            self.metrics.gauge('downloads_in_flight', 1)
+        content_size = 0
+        try:
+            if self.extract:
+                result = download_extract(url, local_path, self.members, session=self.session,
+                                          hashAlgorithm=self.hashAlgorithm, checksum=checksum)
+                self.downloadMeta[idD].update(result)
+                content_size = result['size']
             else:
-                future = executor.submit(download_url, url, local_path)
-                futures.append(future)
-            downloadMeta[idD].update({'url': url, 'local_path': local_path})
-        finished = 0
-        for future in concurrent.futures.as_completed(futures):
-            finished += 1
-            logging.info('download_scenes - download finished by {}/{} scenes'.format(finished,len(futures)))
-    logging.info('download_scenes - all download scenes finished')
+                content_size = download_url(url, local_path, segments=self.segments, session=self.session,
+                                            hashAlgorithm=self.hashAlgorithm, checksum=checksum)
+                if self.hashAlgorithm is not None:
+                    checkpoint = read_checkpoint(local_path + '.size')
+                    self.downloadMeta[idD].update({'hashAlgorithm': self.hashAlgorithm, 'checksum': checkpoint.get('checksum')})
+                if self.inventory is not None:
+                    meta = self.downloadMeta[idD]
+                    self.inventory.add(meta['displayId'], local_path, content_size, meta.get('entityId'), meta.get('datasetName'),
+                                       meta.get('checksum'), meta.get('hashAlgorithm'))
+            return content_size
+        finally:
+            if self.controller is not None:
+                self.controller.release(content_size, error=not content_size)
+            if self.metrics is not None:
+                self.recordDownload(time.monotonic() - start, content_size)
+
+    def recordDownload(self, seconds, content_size):
+        self.metrics.gauge('downloads_in_flight', -1)
+        if not content_size:
+            self.metrics.increment('download_errors')
+            return
+        self.metrics.observe('download_seconds', seconds)
+        self.metrics.increment('download_bytes', content_size)
+        self.metrics.observe('download_bytes_per_second', content_size / max(seconds, 1e-6), buckets=size_buckets)
+
+    def done(self, future):
+        self.finished += 1
+        logging.info('download_scenes - download finished by {}/{} scenes'.format(self.finished,len(self.futures)))
+
+    def wait(self):
+        """
+        Wait for all the submitted downloads and their post-processing to finish.
+        """
+        self.executor.shutdown(wait=True)
+        concurrent.futures.wait(self.processFutures)
+
+def download_segments(url, part_path, info_path, segments, chunk_size=chunk_size, session=requests):
+    """
+    Download or resume a remote URL into a partial file fetching several byte ranges concurrently.
+
+    The partial file is preallocated and every range is written at its offset, so no
+    reassembly is needed. The checkpoint keeps the progress of every range.
+
+    :param url: the remote URL
+    :param part_path: the path to the partial local file
+    :param info_path: the path to the checkpoint sidecar
+    :param segments: number of byte ranges
+    :param chunk_size: size in bytes of the buffer used to stream the content to disk
+    :param session: requests session or module used for the requests
+    :return: the size of the remote content, None if the server does not accept ranges or HEAD requests
+    """
+    dname = osp.basename(part_path)
+    try:
+        with session.head(url, allow_redirects=True) as r:
+            r.raise_for_status()
+            head_url = r.url
+            content_size = int(r.headers.get('content-length', 0))
+            etag = r.headers.get('etag')
+            last_modified = r.headers.get('last-modified')
+            accept_ranges = r.headers.get('accept-ranges', 'none').lower()
+    except (requests.exceptions.RequestException, ValueError) as e:
+        # some servers reject HEAD, like URLs presigned for GET
+        logging.info('download_url - {} - HEAD request failed ({}), using a single stream'.format(dname, e))
+        return None
+    url = head_url
+    validator = etag or last_modified
+    if accept_ranges != 'bytes' or content_size < 2 * min_segment_size or validator is None:
+        logging.info('download_url - {} - segmented download not available, using a single stream'.format(dname))
+        return None
+
+    checkpoint = read_checkpoint(info_path)
+    if (checkpoint.get('size') != content_size or checkpoint.get('etag') != etag
+            or checkpoint.get('last_modified') != last_modified or 'segments' not in checkpoint
+            or not osp.exists(part_path)):
+        segments = min(segments, content_size // min_segment_size)
+        step = -(-content_size // segments)
+        checkpoint = {
+            'size': content_size,
+            'bytes': 0,
+            'etag': etag,
+            'last_modified': last_modified,
+            'segments': [[start, min(start + step, content_size), 0] for start in range(0, content_size, step)]
+        }
+        remove(part_path)
+        with open(ensure_dir(part_path), 'wb') as f:
+            if preallocate and hasattr(os, 'posix_fallocate'):
+                os.posix_fallocate(f.fileno(), 0, content_size)
+            else:
+                f.truncate(content_size)
+        write_checkpoint(info_path, checkpoint)
+        logging.info('download_url - {} - starting download in {} segments...'.format(dname, len(checkpoint['segments'])))
+    else:
+        logging.info('download_url - {} - resuming segmented download from {} bytes'.format(dname, checkpoint['bytes']))
+
+    lock = threading.Lock()
+    fd = os.open(part_path, os.O_WRONLY)
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(checkpoint['segments'])) as executor:
+            futures = [executor.submit(download_segment, url, fd, segment, validator, checkpoint, info_path, lock, chunk_size, session)
+                       for segment in checkpoint['segments'] if segment[0] + segment[2] < segment[1]]
+            for future in concurrent.futures.as_completed(futures):
+                future.result()
+    finally:
+        os.close(fd)
+
+    if checkpoint['bytes'] != content_size:
+        raise DownloadError('download_url - {} - wrong file size'.format(dname))
+    return content_size
+
+def download_segment(url, fd, segment, validator, checkpoint, info_path, lock, chunk_size=chunk_size, session=requests):
+    """
+    Download one byte range of a remote URL into a file descriptor at its offset.
+
+    :param url: the remote URL
+    :param fd: file descriptor of the partial file opened for writing
+    :param segment: list [start, end, written] updated in place
+    :param validator: ETag or Last-Modified value used for If-Range
+    :param checkpoint: checkpoint dictionary containing segment
+    :param info_path: the path to the checkpoint sidecar
+    :param lock: lock protecting the checkpoint
+    :param chunk_size: size in bytes of the buffer used to stream the content to disk
+    :param session: requests session or module used for the request
+    """
+    start, end, written = segment
+    headers = {'Range': 'bytes={}-{}'.format(start + written, end - 1), 'If-Range': validator}
+    pending = 0
+    with session.get(url, headers=headers, stream=True) as r:
+        r.raise_for_status()
+        if r.status_code != 206:
+            with lock:
+                checkpoint.pop('segments', None)
+                write_checkpoint(info_path, checkpoint)
+            raise DownloadError('download_segment - remote file changed or range not satisfied')
+        try:
+            for chunk in r.iter_content(chunk_size=chunk_size):
+                if chunk:
+                    os.pwrite(fd, chunk, start + written + pending)
+                    pending += len(chunk)
+                    if pending >= checkpoint_bytes:
+                        written, pending = update_segment(fd, segment, written, pending, checkpoint, info_path, lock)
+        finally:
+            update_segment(fd, segment, written, pending, checkpoint, info_path, lock)
+
+def update_segment(fd, segment, written, pending, checkpoint, info_path, lock):
+    """
+    Flush a file descriptor and record the pending bytes of a segment in the checkpoint.
+
+    :return: tuple with the updated written bytes and no pending bytes
+    """
+    if pending:
+        os.fsync(fd)
+        with lock:
+            segment[2] = written + pending
+            checkpoint['bytes'] += pending
+            write_checkpoint(info_path, checkpoint)
+    return written + pending, 0
+
+def new_session(pool_size=max_threads):
+    """
+    Create a keep-alive requests session with a connection pool for concurrent requests.
+
+    :param pool_size: maximum number of connections kept alive per host
+    :return: the requests session
+    """
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+def write_stream(r, f, content_size=0, chunk_size=chunk_size, checkpoint=None, info_path=None, hasher=None):
+    """
+    Write the content of a streamed response into a file using bounded chunks.
+
+    :param r: the streamed response
+    :param f: the file object opened in binary mode and positioned at the write offset
+    :param content_size: expected size of the content, used to preallocate the file
+    :param chunk_size: size in bytes of every chunk read from the response
+    :param checkpoint: optional checkpoint dictionary whose 'bytes' are kept up to date
+    :param info_path: path where the checkpoint is stored every checkpoint_bytes
+    :param hasher: optional hashlib object updated with every chunk
+    """
+    if preallocate and content_size > 0 and hasattr(os, 'posix_fallocate'):
+        try:
+            os.posix_fallocate(f.fileno(), 0, content_size)
+        except OSError as e:
+            logging.warning('write_stream - preallocation failed: {}'.format(e))
+    pending = 0
+    try:
+        for chunk in r.iter_content(chunk_size=chunk_size):
+            if chunk:
+                f.write(chunk)
+                if hasher is not None:
+                    hasher.update(chunk)
+                pending += len(chunk)
+                if checkpoint is not None and pending >= checkpoint_bytes:
+                    checkpoint['bytes'] += pending
+                    pending = 0
+                    sync_checkpoint(f, info_path, checkpoint)
+    finally:
+        if checkpoint is not None:
+            checkpoint['bytes'] += pending
+            sync_checkpoint(f, info_path, checkpoint)
+    f.truncate()
+
+def sync_checkpoint(f, info_path, checkpoint):
+    """
+    Flush the file to disk and then store the checkpoint, so the checkpoint never
+    records bytes that are not on disk.
+
+    :param f: the file object being written
+    :param info_path: the path to the checkpoint sidecar
+    :param checkpoint: checkpoint dictionary
+    """
+    f.flush()
+    os.fsync(f.fileno())
+    if info_path is not None:
+        write_checkpoint(info_path, checkpoint)
+
+def read_checkpoint(info_path):
+    """
+    Read a .size sidecar. Old sidecars only contain the content size as an integer.
+
+    :param info_path: the path to the checkpoint sidecar
+    :return: checkpoint dictionary, empty if not available
+    """
+    try:
+        with open(info_path) as f:
+            checkpoint = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if isinstance(checkpoint, int):
+        return {'size': checkpoint, 'bytes': checkpoint}
+    return checkpoint
+
+def write_checkpoint(info_path, checkpoint):
+    """
+    Atomically write a .size sidecar.
+
+    :param info_path: the path to the checkpoint sidecar
+    :param checkpoint: checkpoint dictionary
+    """
+    tmp_path = info_path + '.tmp'
+    with open(ensure_dir(tmp_path), 'w') as f:
+        json.dump(checkpoint, f)
+    os.replace(tmp_path, info_path)
 
 def ensure_dir(path):
     """
@@ -132,7 +723,8 @@ def available_locally(path):
     :param path: the file path
     """
     info_path = path + '.size'
-    if osp.exists(path) and osp.exists(info_path):
-        content_size = int(open(info_path).read())
-        return osp.getsize(path) == content_size and content_size > 0
+    if osp.exists(path):
+        checkpoint = read_checkpoint(info_path)
+        content_size = checkpoint.get('size', 0)
+        return osp.getsize(path) == content_size and checkpoint.get('bytes') == content_size and content_size > 0
     return False
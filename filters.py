@@ -1,7 +1,13 @@
 import time
 import json
+import datetime
+import itertools
+import threading
 import os.path as osp
 
+geoJsonCache = {}
+geoJsonLock = threading.Lock()
+
 def dateCorrection(startDate,endDate):
     if startDate is None:
         startDate = '2000-01-01'
@@ -9,6 +15,78 @@ def dateCorrection(startDate,endDate):
         endDate = time.strftime('%Y-%m-%d')
     return startDate,endDate
 
+def shardDates(startDate,endDate,nShards):
+    startDate,endDate = dateCorrection(startDate,endDate)
+    start = datetime.date.fromisoformat(startDate[:10])
+    end = datetime.date.fromisoformat(endDate[:10])
+    days = (end - start).days + 1
+    nShards = max(1, min(nShards, days))
+    bounds = [start + datetime.timedelta(days=days * k // nShards) for k in range(nShards + 1)]
+    return [(bounds[k].isoformat(), (bounds[k+1] - datetime.timedelta(days=1)).isoformat()) for k in range(nShards)]
+
+def shardBoundingBox(boundingBox,nShards):
+    if isinstance(nShards,int):
+        nShards = (nShards,1)
+    minLon,maxLon,minLat,maxLat = boundingBox
+    nLon,nLat = nShards
+    lons = [minLon + (maxLon - minLon) * k / nLon for k in range(nLon + 1)]
+    lats = [minLat + (maxLat - minLat) * k / nLat for k in range(nLat + 1)]
+    return [(lons[i],lons[i+1],lats[j],lats[j+1]) for i in range(nLon) for j in range(nLat)]
+
+def shardGeoJson(args,nShards):
+    from geometry import tile_geojson
+    if not isinstance(nShards,int):
+        nShards = nShards[0] * nShards[1]
+    geoJson = Filter.spatialFilter(None,args.get('geoJsonType'),args.get('geoJsonCoords'),
+                                   args.get('geoJsonPath'),args.get('geoJsonTolerance'))['spatialFilter']['geoJson']
+    tileType = args.get('tileType','bbox')
+    spatial = []
+    for tile in tile_geojson(geoJson,nShards,tileType):
+        if tileType == 'bbox':
+            spatial.append({'boundingBox': tile, 'geoJsonType': None, 'geoJsonCoords': None, 'geoJsonPath': None})
+        else:
+            spatial.append({'boundingBox': None, 'geoJsonType': tile['type'], 'geoJsonCoords': tile['coordinates'], 'geoJsonPath': None})
+    return spatial
+
+def shardArgs(args,timeShards=1,spaceShards=1):
+    dates = [(args.get('startDate'),args.get('endDate'))]
+    if timeShards != 1:
+        dates = shardDates(args.get('startDate'),args.get('endDate'),timeShards)
+    spatial = [{}]
+    if spaceShards != 1:
+        if args.get('geoJsonPath') is not None or args.get('geoJsonType') is not None:
+            spatial = shardGeoJson(args,spaceShards)
+        elif args.get('boundingBox') is not None:
+            spatial = [{'boundingBox': boundingBox} for boundingBox in shardBoundingBox(args['boundingBox'],spaceShards)]
+        else:
+            raise FilterError('spatial shards need a boundingBox or GeoJSON spatial filter')
+    shards = []
+    for (startDate,endDate),spatialArgs in itertools.product(dates,spatial):
+        shard = dict(args)
+        shard.update({'startDate': startDate, 'endDate': endDate})
+        shard.update(spatialArgs)
+        shards.append(shard)
+    return shards
+
+def loadGeoJson(geoJsonPath,geoJsonTolerance=None):
+    """
+    Read a GeoJSON file, simplified with geoJsonTolerance if specified. The result is cached for
+    every path, modification time and tolerance, so it must not be modified.
+    """
+    path = osp.abspath(osp.join(osp.dirname(__file__),geoJsonPath))
+    key = (path,osp.getmtime(path),geoJsonTolerance)
+    with geoJsonLock:
+        if key in geoJsonCache:
+            return geoJsonCache[key]
+    with open(path,'r') as f:
+        geoJson = json.load(f)
+    if geoJsonTolerance:
+        from geometry import simplify_geojson
+        geoJson = simplify_geojson(geoJson,geoJsonTolerance)
+    with geoJsonLock:
+        geoJsonCache[key] = geoJson
+    return geoJson
+
 class FilterError(Exception):
     """
     Raised when a Filter gets an error.
@@ -27,6 +105,9 @@ class Filter(dict):
             if elem == 'maxResults':
                 maxResults = args.get(elem,None)
                 params.update(self.maxResults(maxResults))
+            elif elem == 'startingNumber':
+                startingNumber = args.get(elem,None)
+                params.update(self.startingNumber(startingNumber))
             elif elem == 'datasetName':
                 datasetName = args.get(elem,None)
                 params.update(self.datasetName(datasetName))
@@ -50,7 +131,8 @@ class Filter(dict):
                     'boundingBox': args.get('boundingBox',None),
                     'geoJsonType': args.get('geoJsonType',None),
                     'geoJsonCoords': args.get('geoJsonCoords',None),
-                    'geoJsonPath': args.get('geoJsonPath',None)
+                    'geoJsonPath': args.get('geoJsonPath',None),
+                    'geoJsonTolerance': args.get('geoJsonTolerance',None)
                 }
                 params.update(self.spatialFilter(**kargs))
             elif elem == 'sceneFilter':
@@ -61,6 +143,7 @@ class Filter(dict):
                     'geoJsonType': args.get('geoJsonType',None),
                     'geoJsonCoords': args.get('geoJsonCoords',None),
                     'geoJsonPath': args.get('geoJsonPath',None),
+                    'geoJsonTolerance': args.get('geoJsonTolerance',None),
                     'minCC': args.get('minCC',None),
                     'maxCC': args.get('maxCC',None),
                     'includeUnknownCC': args.get('includeUnknownCC',None),
@@ -78,6 +161,14 @@ class Filter(dict):
             'maxResults': maxResults
         }
 
+    @staticmethod
+    def startingNumber(startingNumber):
+        if startingNumber is None:
+            return {}
+        return {
+            'startingNumber': startingNumber
+        }
+
     @staticmethod
     def datasetName(datasetName):
         if datasetName is None:
@@ -105,7 +196,7 @@ class Filter(dict):
         }
 
     @staticmethod
-    def spatialFilter(boundingBox,geoJsonType,geoJsonCoords,geoJsonPath):
+    def spatialFilter(boundingBox,geoJsonType,geoJsonCoords,geoJsonPath,geoJsonTolerance=None):
         if geoJsonPath is None:
             if geoJsonType is None:
                 if boundingBox is None:
@@ -123,17 +214,21 @@ class Filter(dict):
                         }
                     }
             else:
+                geoJson = {
+                    'type': geoJsonType,
+                    'coordinates': geoJsonCoords
+                }
+                if geoJsonTolerance:
+                    from geometry import simplify_geojson
+                    geoJson = simplify_geojson(geoJson,geoJsonTolerance)
                 spatialFilter = {
                     'filterType': "geojson",
-                    'geoJson': {
-                        'type': geoJsonType,
-                        'coordinates': geoJsonCoords
-                    }
+                    'geoJson': geoJson
                 }
         else:
             spatialFilter = {
                 'filterType': "geojson",
-                'geoJson': json.load(open(osp.join(osp.dirname(__file__),geoJsonPath),'r'))
+                'geoJson': loadGeoJson(geoJsonPath,geoJsonTolerance)
             }
 
         if len(spatialFilter):
@@ -185,8 +280,13 @@ class Filter(dict):
             else:
                 return {}
             metadataFilter.update({'childFilters': []})
+            fieldLabels = {}
+            for df in datasetFilters:
+                fieldLabels.setdefault(df['fieldLabel'], df)
             for metaName,metaType,metaValue in metadataInfo:
-                metaInfo = [df for df in datasetFilters if df['fieldLabel'] == metaName][0]
+                if metaName not in fieldLabels:
+                    raise FilterError('metadata field {} not one of the dataset filters'.format(metaName))
+                metaInfo = fieldLabels[metaName]
                 childFilter = {
                     'filterId': metaInfo['id'],
                     'filterType': metaType,
@@ -204,11 +304,11 @@ class Filter(dict):
         else:
             return {}
 
-    def sceneFilter(self,startDate,endDate,boundingBox,geoJsonType,geoJsonCoords,geoJsonPath,minCC,maxCC,includeUnknownCC,metadataInfo,datasetFilters):
+    def sceneFilter(self,startDate,endDate,boundingBox,geoJsonType,geoJsonCoords,geoJsonPath,minCC,maxCC,includeUnknownCC,metadataInfo,datasetFilters,geoJsonTolerance=None):
         sceneFilter = {}
         sceneFilter.update(self.acquisitionFilter(startDate,endDate))
         sceneFilter.update(self.cloudCoverFilter(minCC,maxCC,includeUnknownCC))
-        sceneFilter.update(self.spatialFilter(boundingBox,geoJsonType,geoJsonCoords,geoJsonPath))
+        sceneFilter.update(self.spatialFilter(boundingBox,geoJsonType,geoJsonCoords,geoJsonPath,geoJsonTolerance))
         sceneFilter.update(self.metadataFilter(datasetFilters,metadataInfo))
 
         return {
@@ -0,0 +1,413 @@
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from filters import FilterError
+
+# maximum number of elements of the temporary arrays of the vectorized computations
+max_elements = 4 * 1024 * 1024
+# number of rings intersected together with the polygon edges close to them
+ring_chunk = 64
+
+def polygons(geoJson):
+    """
+    Rings of a GeoJSON geometry as arrays, exterior rings counterclockwise and holes clockwise.
+
+    :param geoJson: GeoJSON Polygon, MultiPolygon, Feature or FeatureCollection dictionary
+    :return: list of polygons, every polygon being a list of (n, 2) arrays of closed rings
+    """
+    if np is None:
+        raise FilterError("geometry requires the numpy package")
+    gtype = geoJson.get('type')
+    if gtype == 'FeatureCollection':
+        return [polygon for feature in geoJson['features'] for polygon in polygons(feature)]
+    if gtype == 'Feature':
+        return polygons(geoJson['geometry'])
+    if gtype == 'Polygon':
+        coordinates = [geoJson['coordinates']]
+    elif gtype == 'MultiPolygon':
+        coordinates = geoJson['coordinates']
+    else:
+        raise FilterError('geometry type {} not supported'.format(gtype))
+    result = []
+    for polygon in coordinates:
+        rings = []
+        for k,ring in enumerate(polygon):
+            ring = np.asarray(ring, dtype=np.float64)[:, :2]
+            if not np.array_equal(ring[0], ring[-1]):
+                ring = np.vstack([ring, ring[:1]])
+            if (ring_area(ring) > 0) != (k == 0):
+                ring = ring[::-1]
+            rings.append(ring)
+        result.append(rings)
+    return result
+
+def ring_area(ring):
+    """
+    Signed area of a closed ring, positive if counterclockwise.
+    """
+    x, y = ring[:, 0], ring[:, 1]
+    return .5 * float(np.sum(x[:-1] * y[1:] - x[1:] * y[:-1]))
+
+def area(polys):
+    return sum(ring_area(ring) for polygon in polys for ring in polygon)
+
+def bounds(polys):
+    """
+    Bounds (minLon, minLat, maxLon, maxLat) of a list of polygons.
+    """
+    points = np.vstack([polygon[0] for polygon in polys])
+    return tuple(points.min(axis=0)) + tuple(points.max(axis=0))
+
+def edges(polys):
+    """
+    Start and end points of all the edges of a list of polygons.
+    """
+    rings = [ring for polygon in polys for ring in polygon]
+    return np.vstack([ring[:-1] for ring in rings]), np.vstack([ring[1:] for ring in rings])
+
+def cross(ax, ay, bx, by):
+    return ax * by - ay * bx
+
+def segment_integral(x0, y0, dx, dy, ta, tb):
+    """
+    Integral of x dy along the segment (x0 + t dx, y0 + t dy) from ta to tb.
+    """
+    return dy * (x0 * (tb - ta) + .5 * dx * (tb * tb - ta * ta))
+
+def contains_points(px, py, starts, ends):
+    """
+    Even-odd test of points inside polygons given by their edges, computed by chunks of points.
+
+    :param px, py: arrays of coordinates of the points
+    :param starts, ends: (n, 2) arrays of the start and end points of the edges
+    :return: boolean array
+    """
+    inside = np.zeros(px.shape, dtype=bool)
+    flatX, flatY, flatInside = px.ravel(), py.ravel(), inside.ravel()
+    step = max(1, max_elements // max(len(starts), 1))
+    x1, y1, x2, y2 = starts[:, 0], starts[:, 1], ends[:, 0], ends[:, 1]
+    for k in range(0, len(flatX), step):
+        x, y = flatX[k:k+step, None], flatY[k:k+step, None]
+        crosses = (y1 > y) != (y2 > y)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            xCross = x1 + (y - y1) * (x2 - x1) / (y2 - y1)
+        flatInside[k:k+step] = np.sum(crosses & (x < xCross), axis=1) % 2 == 1
+    return flatInside.reshape(px.shape)
+
+def convex_rings(coords, ringOffsets, rings):
+    """
+    Closed rings stored as in results.SceneTable padded to the same number of points repeating
+    their last point, and oriented counterclockwise.
+
+    :param coords: (n, 2) array of the coordinates of all the rings
+    :param ringOffsets: array of the offsets of every ring in coords
+    :param rings: array of the indices of the rings
+    :return: (m, k, 2) array
+    """
+    sizes = ringOffsets[rings + 1] - ringOffsets[rings]
+    points = np.minimum(np.arange(sizes.max()), sizes[:, None] - 1)
+    padded = coords[ringOffsets[rings][:, None] + points]
+    x, y = padded[..., 0], padded[..., 1]
+    clockwise = np.sum(x[:, :-1] * y[:, 1:] - x[:, 1:] * y[:, :-1], axis=1) < 0
+    padded[clockwise] = padded[clockwise, ::-1]
+    return padded
+
+def intersection_areas(rings, polys):
+    """
+    Vectorized areas of the intersections of convex rings with polygons.
+
+    By Green's theorem, the area of the intersection is the integral of x dy along its boundary,
+    which is made of the edges of the polygons inside every ring and of the edges of every ring
+    inside the polygons. The rings are assumed convex, as the footprints of the scenes.
+
+    The rings are processed in chunks of close rings, sorted as in STRtree, so only the polygon
+    edges whose bounding box intersects the bounding box of a chunk are used.
+
+    :param rings: (m, k, 2) array of closed convex rings from convex_rings
+    :param polys: list of polygons from polygons
+    :return: array of m areas
+    """
+    starts, ends = edges(polys)
+    edgeMin, edgeMax = np.minimum(starts, ends), np.maximum(starts, ends)
+    ringMin, ringMax = rings.min(axis=1), rings.max(axis=1)
+    inside = contains_points(rings[:, 0, 0], rings[:, 0, 1], starts, ends)
+    order = str_order((ringMin[:, 0] + ringMax[:, 0]) / 2, (ringMin[:, 1] + ringMax[:, 1]) / 2, ring_chunk)
+    result = np.zeros(len(rings))
+    for k in range(0, len(rings), ring_chunk):
+        chunk = order[k:k+ring_chunk]
+        lo, hi = ringMin[chunk].min(axis=0), ringMax[chunk].max(axis=0)
+        near = np.all(edgeMax >= lo, axis=1) & np.all(edgeMin <= hi, axis=1)
+        step = max(1, max_elements // (max(int(near.sum()), 1) * rings.shape[1]))
+        for j in range(0, len(chunk), step):
+            sub = chunk[j:j+step]
+            result[sub] = (polygon_edges_inside(rings[sub], starts[near], ends[near])
+                           + ring_edges_inside(rings[sub], starts[near], ends[near], inside[sub]))
+    return np.maximum(result, 0.)
+
+def polygon_edges_inside(rings, starts, ends):
+    """
+    Integral of x dy along the parts of the polygon edges inside every convex ring (Cyrus-Beck clipping).
+    """
+    q0 = rings[:, None, :-1, :]
+    qd = rings[:, None, 1:, :] - q0
+    p0 = starts[None, :, None, :]
+    pd = (ends - starts)[None, :, None, :]
+    num = cross(qd[..., 0], qd[..., 1], p0[..., 0] - q0[..., 0], p0[..., 1] - q0[..., 1])
+    den = cross(qd[..., 0], qd[..., 1], pd[..., 0], pd[..., 1])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = -num / den
+    t0 = np.max(np.where(den > 0, t, 0.), axis=2).clip(0., 1.)
+    t1 = np.min(np.where(den < 0, t, 1.), axis=2).clip(0., 1.)
+    outside = np.any((den == 0) & (num < 0), axis=2) | (t1 <= t0)
+    x0, y0 = starts[:, 0], starts[:, 1]
+    dx, dy = ends[:, 0] - x0, ends[:, 1] - y0
+    integral = segment_integral(x0, y0, dx, dy, t0, t1)
+    return np.sum(np.where(outside, 0., integral), axis=1)
+
+def ring_edges_inside(rings, starts, ends, inside0):
+    """
+    Integral of x dy along the parts of the ring edges inside the polygons, crossing the polygon
+    edges in order along every ring edge. The first point of every ring is inside the polygons if
+    inside0, and the state of the next points changes with every crossing.
+    """
+    a = rings[:, :-1, None, :]
+    d = rings[:, 1:, None, :] - a
+    c = starts[None, None, :, :]
+    f = (ends - starts)[None, None, :, :]
+    den = cross(d[..., 0], d[..., 1], f[..., 0], f[..., 1])
+    cax, cay = c[..., 0] - a[..., 0], c[..., 1] - a[..., 1]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = cross(cax, cay, f[..., 0], f[..., 1]) / den
+        u = cross(cax, cay, d[..., 0], d[..., 1]) / den
+    valid = (den != 0) & (t > 0) & (t < 1) & (u >= 0) & (u < 1)
+    crossings = np.sort(np.where(valid, t, 1.), axis=2)
+    parity = np.cumsum(np.sum(valid, axis=2), axis=1) - np.sum(valid, axis=2)
+    inside0 = inside0[:, None] != (parity % 2 == 1)
+    n = crossings.shape[:2]
+    boundaries = np.concatenate([np.zeros(n + (1,)), crossings, np.ones(n + (1,))], axis=2)
+    odd = np.arange(boundaries.shape[2] - 1) % 2 == 1
+    insideInterval = inside0[..., None] != odd
+    x0, y0 = rings[:, :-1, 0, None], rings[:, :-1, 1, None]
+    dx, dy = d[..., 0], d[..., 1]
+    integral = segment_integral(x0, y0, dx, dy, boundaries[..., :-1], boundaries[..., 1:])
+    return np.sum(np.where(insideInterval, integral, 0.), axis=(1, 2))
+
+def str_order(centerX, centerY, nodeSize):
+    """
+    Sort-Tile-Recursive order of some points: vertical slices sorted by x, sorted by y inside every
+    slice, so consecutive groups of nodeSize points are close.
+    """
+    n = len(centerX)
+    sliceSize = int(np.ceil(np.sqrt(np.ceil(n / nodeSize)))) * nodeSize
+    order = np.argsort(centerX, kind='stable')
+    sliceIds = np.empty(n, dtype=np.int64)
+    sliceIds[order] = np.arange(n) // sliceSize
+    return np.lexsort([centerY, sliceIds])
+
+class STRtree(object):
+    """
+    Static R-tree of bounding boxes packed with the Sort-Tile-Recursive algorithm and queried
+    level by level with vectorized box tests.
+    """
+
+    def __init__(self, minX, minY, maxX, maxY, nodeSize=16):
+        """
+        :param minX, minY, maxX, maxY: arrays of the bounds of the items
+        :param nodeSize: maximum number of children of every node
+        """
+        if np is None:
+            raise FilterError("STRtree requires the numpy package")
+        self.nodeSize = nodeSize
+        boxes = np.column_stack([minX, minY, maxX, maxY]).astype(np.float64)
+        valid = ~np.isnan(boxes).any(axis=1)
+        items = np.nonzero(valid)[0]
+        boxes = boxes[valid]
+        n = len(items)
+        if n:
+            order = str_order((boxes[:, 0] + boxes[:, 2]) / 2, (boxes[:, 1] + boxes[:, 3]) / 2, nodeSize)
+            items, boxes = items[order], boxes[order]
+        self.items = items
+        self.levels = [boxes]
+        while len(self.levels[-1]) > nodeSize:
+            self.levels.append(self.parents(self.levels[-1]))
+
+    def parents(self, boxes):
+        starts = np.arange(0, len(boxes), self.nodeSize)
+        return np.column_stack([np.minimum.reduceat(boxes[:, 0], starts), np.minimum.reduceat(boxes[:, 1], starts),
+                                np.maximum.reduceat(boxes[:, 2], starts), np.maximum.reduceat(boxes[:, 3], starts)])
+
+    def query(self, minX, minY, maxX, maxY):
+        """
+        Items whose bounding box intersects a box.
+
+        :return: sorted array of the indices of the items
+        """
+        nodes = np.arange(len(self.levels[-1]))
+        for level in range(len(self.levels) - 1, -1, -1):
+            boxes = self.levels[level][nodes]
+            hit = (boxes[:, 0] <= maxX) & (boxes[:, 2] >= minX) & (boxes[:, 1] <= maxY) & (boxes[:, 3] >= minY)
+            nodes = nodes[hit]
+            if level:
+                children = (nodes[:, None] * self.nodeSize + np.arange(self.nodeSize)).ravel()
+                nodes = children[children < len(self.levels[level - 1])]
+        return np.sort(self.items[nodes])
+
+def simplify_ring(ring, tolerance):
+    """
+    Simplify a closed ring with the Douglas-Peucker algorithm, keeping the original ring if the
+    simplified one has less than 4 points.
+
+    :param ring: list of [lon, lat] points of a closed ring
+    :param tolerance: maximum distance in degrees between the original and the simplified ring
+    :return: list of [lon, lat] points
+    """
+    if len(ring) <= 4:
+        return ring
+    first = ring[0]
+    far = max(range(1, len(ring) - 1), key=lambda k: (ring[k][0] - first[0]) ** 2 + (ring[k][1] - first[1]) ** 2)
+    simplified = simplify_line(ring[:far + 1], tolerance)[:-1] + simplify_line(ring[far:], tolerance)
+    return simplified if len(simplified) >= 4 else ring
+
+def simplify_line(line, tolerance):
+    keep = [False] * len(line)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(line) - 1)]
+    while stack:
+        i, j = stack.pop()
+        (x1, y1), (x2, y2) = line[i][:2], line[j][:2]
+        dx, dy = x2 - x1, y2 - y1
+        norm = (dx * dx + dy * dy) ** .5
+        maxDistance, index = 0., None
+        for k in range(i + 1, j):
+            x, y = line[k][:2]
+            if norm > 0:
+                distance = abs(dy * (x - x1) - dx * (y - y1)) / norm
+            else:
+                distance = ((x - x1) ** 2 + (y - y1) ** 2) ** .5
+            if distance > maxDistance:
+                maxDistance, index = distance, k
+        if index is not None and maxDistance > tolerance:
+            keep[index] = True
+            stack.extend([(i, index), (index, j)])
+    return [point for point,kept in zip(line, keep) if kept]
+
+def simplify_geojson(geoJson, tolerance):
+    """
+    Simplify all the rings of a GeoJSON geometry.
+
+    :param geoJson: GeoJSON Polygon, MultiPolygon, Feature or FeatureCollection dictionary
+    :param tolerance: maximum distance in degrees between the original and the simplified rings
+    :return: new GeoJSON dictionary
+    """
+    gtype = geoJson.get('type')
+    if gtype == 'FeatureCollection':
+        return dict(geoJson, features=[simplify_geojson(feature, tolerance) for feature in geoJson['features']])
+    if gtype == 'Feature':
+        return dict(geoJson, geometry=simplify_geojson(geoJson['geometry'], tolerance))
+    if gtype == 'Polygon':
+        return dict(geoJson, coordinates=[simplify_ring(ring, tolerance) for ring in geoJson['coordinates']])
+    if gtype == 'MultiPolygon':
+        return dict(geoJson, coordinates=[[simplify_ring(ring, tolerance) for ring in polygon] for polygon in geoJson['coordinates']])
+    raise FilterError('geometry type {} not supported'.format(gtype))
+
+def exterior_rings(geoJson):
+    gtype = geoJson.get('type')
+    if gtype == 'FeatureCollection':
+        return [ring for feature in geoJson['features'] for ring in exterior_rings(feature)]
+    if gtype == 'Feature':
+        return exterior_rings(geoJson['geometry'])
+    if gtype == 'Polygon':
+        return geoJson['coordinates'][:1]
+    if gtype == 'MultiPolygon':
+        return [polygon[0] for polygon in geoJson['coordinates']]
+    raise FilterError('geometry type {} not supported'.format(gtype))
+
+def clip_ring(ring, box):
+    """
+    Clip a ring by a box with the Sutherland-Hodgman algorithm.
+
+    :param ring: list of [lon, lat] points of a closed ring
+    :param box: (minLon, maxLon, minLat, maxLat)
+    :return: list of (lon, lat) points of the clipped ring, not closed, empty if outside the box
+    """
+    minLon, maxLon, minLat, maxLat = box
+    points = [tuple(point[:2]) for point in ring[:-1]]
+    for axis, limit, keepGreater in [(0, minLon, True), (0, maxLon, False), (1, minLat, True), (1, maxLat, False)]:
+        inside = lambda p: p[axis] >= limit if keepGreater else p[axis] <= limit
+        clipped = []
+        for k in range(len(points)):
+            current, previous = points[k], points[k - 1]
+            if inside(current) != inside(previous):
+                t = (limit - previous[axis]) / (current[axis] - previous[axis])
+                clipped.append(tuple(previous[i] + t * (current[i] - previous[i]) for i in range(2)))
+            if inside(current):
+                clipped.append(current)
+        points = clipped
+        if not points:
+            break
+    return points
+
+def convex_hull(points):
+    """
+    Convex hull of some points with the monotone chain algorithm.
+
+    :param points: list of (lon, lat) points
+    :return: list of [lon, lat] points of the closed counterclockwise hull
+    """
+    points = sorted(set(points))
+    if len(points) < 3:
+        return [list(point) for point in points]
+    turn = lambda o, a, b: (a[0] - o[0]) * (b[1] - o[1]) - (a[1] - o[1]) * (b[0] - o[0])
+    lower, upper = [], []
+    for point in points:
+        while len(lower) >= 2 and turn(lower[-2], lower[-1], point) <= 0:
+            lower.pop()
+        lower.append(point)
+    for point in reversed(points):
+        while len(upper) >= 2 and turn(upper[-2], upper[-1], point) <= 0:
+            upper.pop()
+        upper.append(point)
+    hull = lower[:-1] + upper[:-1]
+    return [list(point) for point in hull + hull[:1]]
+
+def tile_geojson(geoJson, maxTiles, tileType='bbox'):
+    """
+    Split a GeoJSON geometry in at most maxTiles tiles covering it.
+
+    The bounding box of the geometry is divided in a grid of at most maxTiles cells with the
+    aspect ratio of the geometry, and every cell intersecting the geometry gives a tile: the
+    bounding box ('bbox') or the convex hull ('convex') of the part of the geometry in the cell.
+    Holes are ignored, so the tiles always cover the geometry.
+
+    :param geoJson: GeoJSON Polygon, MultiPolygon, Feature or FeatureCollection dictionary
+    :param maxTiles: maximum number of tiles
+    :param tileType: 'bbox' for (minLon, maxLon, minLat, maxLat) tuples or 'convex' for GeoJSON Polygons
+    :return: list of tiles
+    """
+    if tileType not in ('bbox', 'convex'):
+        raise FilterError('tile type {} not one of bbox or convex'.format(tileType))
+    rings = exterior_rings(geoJson)
+    points = [point for ring in rings for point in ring]
+    minLon, maxLon = min(p[0] for p in points), max(p[0] for p in points)
+    minLat, maxLat = min(p[1] for p in points), max(p[1] for p in points)
+    width, height = max(maxLon - minLon, 1e-9), max(maxLat - minLat, 1e-9)
+    nLon = max(1, min(maxTiles, int(round((maxTiles * width / height) ** .5))))
+    nLat = max(1, maxTiles // nLon)
+    tiles = []
+    for i in range(nLon):
+        for j in range(nLat):
+            cell = (minLon + width * i / nLon, minLon + width * (i + 1) / nLon,
+                    minLat + height * j / nLat, minLat + height * (j + 1) / nLat)
+            parts = [point for ring in rings for point in clip_ring(ring, cell)]
+            if len(parts) < 3:
+                continue
+            if tileType == 'bbox':
+                tiles.append((min(p[0] for p in parts), max(p[0] for p in parts),
+                              min(p[1] for p in parts), max(p[1] for p in parts)))
+            else:
+                hull = convex_hull(parts)
+                if len(hull) >= 4:
+                    tiles.append({'type': 'Polygon', 'coordinates': [hull]})
+    return tiles
@@ -0,0 +1,169 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+import os.path as osp
+
+from downloader import read_checkpoint
+
+# maximum number of parameters in a SQLite query
+max_variables = 500
+
+class Inventory(object):
+    """
+    SQLite index of the scenes available locally, keyed by displayId.
+
+    It replaces the stat and .size sidecar checks of every scene by indexed queries, so knowing
+    which scenes of a big list are missing is a single bulk query. The index is filled from the
+    existing .size sidecars the first time it is used with a directory, and reconcile compares
+    it with the files in the directory.
+    """
+
+    def __init__(self, path, directory=None):
+        """
+        :param path: path to the SQLite database file
+        :param directory: directory of the tar files, migrated from the .size sidecars the first time
+        """
+        self.path = str(path)
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.executescript('''
+            CREATE TABLE IF NOT EXISTS scenes (
+                displayId TEXT PRIMARY KEY,
+                entityId TEXT,
+                datasetName TEXT,
+                path TEXT,
+                size INTEGER,
+                checksum TEXT,
+                hashAlgorithm TEXT,
+                mtime REAL,
+                updated REAL
+            );
+            CREATE INDEX IF NOT EXISTS scenes_entityId ON scenes (entityId);
+            CREATE TABLE IF NOT EXISTS migrations (
+                directory TEXT PRIMARY KEY,
+                updated REAL
+            );
+        ''')
+        if directory is not None:
+            self.migrate(directory)
+
+    def execute(self, sql, params=()):
+        with self.lock:
+            return self.connection.execute(sql, params).fetchall()
+
+    def add(self, displayId, path, size, entityId=None, datasetName=None, checksum=None, hashAlgorithm=None, mtime=None):
+        """
+        Add or replace a scene available locally.
+
+        :param displayId: displayId of the scene
+        :param path: path to the local file
+        :param size: size of the file in bytes
+        :param entityId: entityId of the scene
+        :param datasetName: name of the dataset of the scene
+        :param checksum: checksum of the file
+        :param hashAlgorithm: hashlib algorithm of the checksum
+        :param mtime: modification time of the file, read from the file by default
+        """
+        if mtime is None:
+            mtime = osp.getmtime(path)
+        self.execute('INSERT OR REPLACE INTO scenes VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                     (displayId, entityId, datasetName, osp.abspath(path), size, checksum, hashAlgorithm, mtime, time.time()))
+
+    def remove(self, displayId):
+        self.execute('DELETE FROM scenes WHERE displayId = ?', (displayId,))
+
+    def get(self, displayId):
+        """
+        Get a scene from the index.
+
+        :param displayId: displayId of the scene
+        :return: dictionary with the scene, None if not available locally
+        """
+        with self.lock:
+            cursor = self.connection.execute('SELECT * FROM scenes WHERE displayId = ?', (displayId,))
+            row = cursor.fetchone()
+            if row is None:
+                return None
+            return dict(zip([column[0] for column in cursor.description], row))
+
+    def available(self, displayId):
+        return len(self.execute('SELECT 1 FROM scenes WHERE displayId = ?', (displayId,))) > 0
+
+    def missing(self, displayIds):
+        """
+        Bulk query of the scenes not available locally.
+
+        :param displayIds: list of displayIds
+        :return: list of the displayIds not in the index, in the same order
+        """
+        displayIds = list(displayIds)
+        found = set()
+        for k in range(0, len(displayIds), max_variables):
+            chunk = displayIds[k:k+max_variables]
+            rows = self.execute('SELECT displayId FROM scenes WHERE displayId IN ({})'.format(','.join('?' * len(chunk))), chunk)
+            found.update(row[0] for row in rows)
+        return [displayId for displayId in displayIds if displayId not in found]
+
+    def migrate(self, directory):
+        """
+        Fill the index from the .size sidecars of a directory, only the first time.
+
+        :param directory: directory of the tar files
+        """
+        directory = osp.abspath(directory)
+        if len(self.execute('SELECT 1 FROM migrations WHERE directory = ?', (directory,))):
+            return
+        added, removed = self.reconcile(directory)
+        self.execute('INSERT OR REPLACE INTO migrations VALUES (?, ?)', (directory, time.time()))
+        logging.info('Inventory.migrate - {} scenes migrated from {}'.format(added, directory))
+
+    def reconcile(self, directory):
+        """
+        Scan a directory once and update the index: scenes whose file is missing or changed are
+        removed, and complete tar files with a valid .size sidecar not in the index are added.
+
+        Only the sidecars of files not in the index or whose size or mtime changed are read.
+
+        :param directory: directory of the tar files
+        :return: number of scenes added and removed
+        """
+        directory = osp.abspath(directory)
+        files = {}
+        if osp.isdir(directory):
+            for entry in os.scandir(directory):
+                if entry.name.endswith('.tar') and entry.is_file():
+                    stat = entry.stat()
+                    files[entry.name[:-4]] = (entry.path, stat.st_size, stat.st_mtime)
+        indexed = {displayId: (path, size, mtime) for displayId,path,size,mtime in
+                   self.execute('SELECT displayId, path, size, mtime FROM scenes')
+                   if osp.dirname(osp.abspath(path)) == directory}
+        removed = [displayId for displayId,(path,size,mtime) in indexed.items()
+                   if displayId not in files or files[displayId][1] != size]
+        added = []
+        for displayId,(path,size,mtime) in files.items():
+            if displayId in indexed and displayId not in removed and indexed[displayId][2] == mtime:
+                continue
+            checkpoint = read_checkpoint(path + '.size')
+            if size > 0 and checkpoint.get('size') == size and checkpoint.get('bytes') == size:
+                added.append((displayId, None, None, path, size, checkpoint.get('checksum'), checkpoint.get('hashAlgorithm'),
+                              mtime, time.time()))
+            elif displayId in indexed and displayId not in removed:
+                removed.append(displayId)
+        with self.lock:
+            with self.connection:
+                self.connection.execute('BEGIN')
+                self.connection.executemany('DELETE FROM scenes WHERE displayId = ?', [(displayId,) for displayId in removed])
+                self.connection.executemany('''INSERT INTO scenes VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                    ON CONFLICT(displayId) DO UPDATE SET path = excluded.path, size = excluded.size,
+                    checksum = COALESCE(excluded.checksum, checksum),
+                    hashAlgorithm = COALESCE(excluded.hashAlgorithm, hashAlgorithm), mtime = excluded.mtime, updated = excluded.updated''', added)
+        logging.info('Inventory.reconcile - {} scenes added and {} removed in {}'.format(len(added), len(removed), directory))
+        return len(added), len(removed)
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
@@ -0,0 +1,112 @@
+import json
+import sqlite3
+import threading
+import time
+
+class Journal(object):
+    """
+    Crash-safe SQLite journal of the retrieval jobs, so a job can be resumed after a restart.
+
+    Every job is identified by its label and records the dataset, the entityIds, the labels of
+    the orders, the number of requested downloads and the state of every download.
+    Job states are 'ordering', 'requested' and 'complete'. Download states are 'preparing',
+    'started', 'done' and 'failed'.
+    """
+
+    def __init__(self, path):
+        """
+        :param path: path to the SQLite database file
+        """
+        self.path = str(path)
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.executescript('''
+            CREATE TABLE IF NOT EXISTS jobs (
+                label TEXT PRIMARY KEY,
+                datasetName TEXT,
+                entityIds TEXT,
+                labels TEXT,
+                requestedCount INTEGER,
+                state TEXT,
+                updated REAL
+            );
+            CREATE TABLE IF NOT EXISTS downloads (
+                downloadId TEXT PRIMARY KEY,
+                label TEXT,
+                url TEXT,
+                meta TEXT,
+                state TEXT,
+                updated REAL
+            );
+            CREATE INDEX IF NOT EXISTS downloads_label ON downloads (label);
+        ''')
+
+    def execute(self, sql, params=()):
+        with self.lock:
+            return self.connection.execute(sql, params).fetchall()
+
+    def startJob(self, label, datasetName, entityIds):
+        self.execute('INSERT OR REPLACE INTO jobs VALUES (?, ?, ?, ?, ?, ?, ?)',
+                     (label, datasetName, json.dumps(entityIds), json.dumps([label]), 0, 'ordering', time.time()))
+
+    def jobRequested(self, label, labels, requestedCount):
+        self.execute('UPDATE jobs SET labels = ?, requestedCount = ?, state = ?, updated = ? WHERE label = ?',
+                     (json.dumps(labels), requestedCount, 'requested', time.time(), label))
+
+    def completeJob(self, label):
+        self.execute('UPDATE jobs SET state = ?, updated = ? WHERE label = ?', ('complete', time.time(), label))
+
+    def recordDownloads(self, label, downloadMeta):
+        """
+        Record the metadata of the downloads, keeping the state of the ones already recorded.
+        """
+        now = time.time()
+        with self.lock:
+            with self.connection:
+                self.connection.execute('BEGIN')
+                for idD,meta in list(downloadMeta.items()):
+                    self.connection.execute('INSERT OR IGNORE INTO downloads VALUES (?, ?, ?, ?, ?, ?)',
+                                            (idD, label, meta.get('url'), json.dumps(meta, default=str), 'preparing', now))
+
+    def downloadStarted(self, idD, meta):
+        self.execute('UPDATE downloads SET url = ?, meta = ?, state = ?, updated = ? WHERE downloadId = ?',
+                     (meta.get('url'), json.dumps(meta, default=str), 'started', time.time(), idD))
+
+    def downloadFinished(self, idD, meta, success=True):
+        self.execute('UPDATE downloads SET meta = ?, state = ?, updated = ? WHERE downloadId = ?',
+                     (json.dumps(meta, default=str), 'done' if success else 'failed', time.time(), idD))
+
+    def getJob(self, label):
+        """
+        Get a job with the state and metadata of its downloads.
+
+        :param label: label of the job
+        :return: dictionary with the job, None if the job is not in the journal
+        """
+        rows = self.execute('SELECT datasetName, entityIds, labels, requestedCount, state FROM jobs WHERE label = ?', (label,))
+        if not len(rows):
+            return None
+        datasetName, entityIds, labels, requestedCount, state = rows[0]
+        downloads = {idD: {'url': url, 'meta': json.loads(meta), 'state': dstate}
+                     for idD,url,meta,dstate in self.execute('SELECT downloadId, url, meta, state FROM downloads WHERE label = ?', (label,))}
+        return {
+            'label': label,
+            'datasetName': datasetName,
+            'entityIds': json.loads(entityIds),
+            'labels': json.loads(labels),
+            'requestedCount': requestedCount,
+            'state': state,
+            'downloads': downloads
+        }
+
+    def pendingJobs(self):
+        """
+        Labels of the jobs not completed.
+        """
+        return [row[0] for row in self.execute('SELECT label FROM jobs WHERE state != ?', ('complete',))]
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
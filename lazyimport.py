@@ -0,0 +1,41 @@
+import importlib
+import importlib.util
+import threading
+import types
+
+class LazyModule(types.ModuleType):
+    """
+    Module proxy importing the real module when one of its attributes is first accessed.
+
+    The import is done with importlib.import_module under a lock, so threads accessing the module
+    together all get the fully initialized module, unlike importlib.util.LazyLoader before Python
+    3.12. The proxy is not added to sys.modules, so other imports of the module are not affected.
+    """
+
+    def __init__(self, name):
+        super(LazyModule, self).__init__(name)
+        self._lock = threading.Lock()
+        self._module = None
+
+    def __getattr__(self, attr):
+        module = self._module
+        if module is None:
+            with self._lock:
+                if self._module is None:
+                    self._module = importlib.import_module(self.__name__)
+                module = self._module
+        return getattr(module, attr)
+
+def lazy_import(name):
+    """
+    Import a module whose code is only executed when one of its attributes is first accessed.
+
+    Used for heavy dependencies like requests, so importing api or downloader stays cheap for
+    short-lived processes that may never send a request.
+
+    :param name: name of the module
+    :return: the module proxy, raising ImportError now if the module is not installed
+    """
+    if importlib.util.find_spec(name) is None:
+        raise ImportError("No module named '{}'".format(name), name=name)
+    return LazyModule(name)
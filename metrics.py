@@ -0,0 +1,186 @@
+import bisect
+import contextlib
+import logging
+import threading
+import time
+
+# upper bounds of the histogram buckets in seconds
+latency_buckets = [.005, .01, .025, .05, .1, .25, .5, 1., 2.5, 5., 10., 30., 60., 120., 300., 600., 1800., 3600.]
+# upper bounds of the histogram buckets in bytes
+size_buckets = [2 ** k for k in range(6, 36, 2)]
+
+class Histogram(object):
+    """
+    Cumulative histogram with fixed buckets, keeping the count, sum, minimum and maximum.
+    """
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.
+        self.min = None
+        self.max = None
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def quantile(self, q):
+        """
+        Estimate a quantile interpolating linearly inside its bucket.
+        """
+        if not self.count:
+            return None
+        rank = q * self.count
+        cumulative = 0
+        for k,count in enumerate(self.counts):
+            if count and cumulative + count >= rank:
+                lower = self.min if k == 0 else max(self.buckets[k - 1], self.min)
+                upper = self.max if k == len(self.buckets) else min(self.buckets[k], self.max)
+                return lower + (upper - lower) * (rank - cumulative) / count
+            cumulative += count
+        return self.max
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'min': self.min,
+            'max': self.max,
+            'p50': self.quantile(.5),
+            'p99': self.quantile(.99)
+        }
+
+class Metrics(object):
+    """
+    Thread-safe registry of counters, gauges and histograms identified by a name and labels.
+
+    Objects accepting a metrics argument (M2M, DownloadPool, retry_connect) only record metrics
+    when it is specified, so there is no cost when disabled. Every recorded value is also passed
+    to the exporters, functions called as exporter(kind, name, value, labels) with kind one of
+    'counter', 'gauge' or 'histogram', which can forward them to Prometheus or OpenTelemetry
+    instruments. Recorded metrics:
+
+    - m2m_request_seconds: latency of the M2M requests by endpoint
+    - m2m_request_bytes, m2m_response_bytes: payload sizes by endpoint
+    - m2m_requests_in_flight: M2M requests being processed
+    - m2m_errors: M2M requests failed by endpoint
+    - m2m_retries: M2M requests retried by endpoint and reason (timeout or throttled)
+    - m2m_rate_limit_seconds: time waiting for the rate limiter
+    - download_preparation_seconds: time from the download request until the download is available
+    - downloads_queued, downloads_in_flight: downloads waiting for a thread and being downloaded
+    - download_seconds, download_bytes: duration and size of every finished download
+    - download_bytes_per_second: throughput of every finished download
+    - download_errors: downloads failed
+    """
+
+    def __init__(self, exporters=[]):
+        """
+        :param exporters: list of functions called with every recorded value
+        """
+        self.exporters = list(exporters)
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+
+    def addExporter(self, exporter):
+        self.exporters.append(exporter)
+
+    def export(self, kind, name, value, labels):
+        for exporter in self.exporters:
+            try:
+                exporter(kind, name, value, labels)
+            except Exception as e:
+                logging.warning('Metrics.export - exporter failed for {}: {}'.format(name, e))
+
+    def increment(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+        self.export('counter', name, value, labels)
+
+    def gauge(self, name, delta, **labels):
+        """
+        Add delta to a gauge, like the number of tasks in flight.
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            value = self.gauges[key] = self.gauges.get(key, 0) + delta
+        self.export('gauge', name, value, labels)
+
+    def observe(self, name, value, buckets=latency_buckets, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(buckets)
+            histogram.observe(value)
+        self.export('histogram', name, value, labels)
+
+    @contextlib.contextmanager
+    def timer(self, name, inflight=None, **labels):
+        """
+        Context manager observing the seconds spent in a block in a histogram, and counting the
+        blocks running in the gauge inflight if specified.
+        """
+        if inflight is not None:
+            self.gauge(inflight, 1, **labels)
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(name, time.monotonic() - start, **labels)
+            if inflight is not None:
+                self.gauge(inflight, -1, **labels)
+
+    def snapshot(self):
+        """
+        Current values of all the metrics.
+
+        :return: dictionary with counters, gauges and histogram summaries keyed by name and labels
+        """
+        with self.lock:
+            return {
+                'counters': {format_key(key): value for key,value in self.counters.items()},
+                'gauges': {format_key(key): value for key,value in self.gauges.items()},
+                'histograms': {format_key(key): histogram.summary() for key,histogram in self.histograms.items()}
+            }
+
+    def prometheus(self):
+        """
+        Metrics in the Prometheus text exposition format, to be served by an HTTP endpoint.
+        """
+        lines = []
+        with self.lock:
+            for (name,labels),value in sorted(self.counters.items()):
+                lines.append('{}_total{} {}'.format(name, format_labels(labels), value))
+            for (name,labels),value in sorted(self.gauges.items()):
+                lines.append('{}{} {}'.format(name, format_labels(labels), value))
+            for (name,labels),histogram in sorted(self.histograms.items()):
+                cumulative = 0
+                for bound,count in zip(histogram.buckets + ['+Inf'], histogram.counts):
+                    cumulative += count
+                    lines.append('{}_bucket{} {}'.format(name, format_labels(labels + (('le', bound),)), cumulative))
+                lines.append('{}_sum{} {}'.format(name, format_labels(labels), histogram.sum))
+                lines.append('{}_count{} {}'.format(name, format_labels(labels), histogram.count))
+        return '\n'.join(lines) + '\n'
+
+    def reset(self):
+        with self.lock:
+            self.counters.clear()
+            self.gauges.clear()
+            self.histograms.clear()
+
+def format_key(key):
+    name, labels = key
+    return name + format_labels(labels)
+
+def format_labels(labels):
+    if not len(labels):
+        return ''
+    return '{' + ','.join('{}="{}"'.format(label, value) for label,value in labels) + '}'
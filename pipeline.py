@@ -0,0 +1,185 @@
+import logging
+import queue
+import threading
+
+from downloader import DownloadPool, max_threads
+
+class Pipeline(object):
+    """
+    Streaming search, order and download pipeline built on the M2M methods.
+
+    Pages of search results are grouped in order batches, the batches are ordered by orderWorkers
+    threads, every download is submitted to the download pool as soon as it is available and
+    every finished scene is passed to callback. The order and download stages are bounded, so
+    the search stops when downstream stages are full.
+    """
+
+    def __init__(self, m2m, datasetName, callback=None, filterOptions={}, label='m2m-api_pipeline',
+                 pageSize=1000, batchSize=100, orderWorkers=2, downloadWorkers=max_threads, queueSize=None):
+        """
+        :param m2m: M2M object
+        :param datasetName: name of the dataset
+        :param callback: function called with the downloadId and its metadata when a scene is downloaded
+        :param filterOptions: download options filter, see M2M.downloadOptions
+        :param label: prefix of the labels of every order batch
+        :param pageSize: number of scenes requested in every search page
+        :param batchSize: number of scenes ordered in every order batch
+        :param orderWorkers: number of order batches processed concurrently
+        :param downloadWorkers: number of concurrent downloads
+        :param queueSize: maximum number of batches and of downloads waiting, 2*orderWorkers and
+            2*downloadWorkers by default
+        """
+        self.m2m = m2m
+        self.datasetName = datasetName
+        self.callback = callback
+        self.filterOptions = filterOptions
+        self.label = label
+        self.pageSize = pageSize
+        self.batchSize = batchSize
+        self.orderWorkers = orderWorkers
+        self.downloadWorkers = downloadWorkers
+        self.orderQueue = queue.Queue(maxsize=queueSize or 2 * orderWorkers)
+        self.downloadSlots = threading.BoundedSemaphore(queueSize or 2 * downloadWorkers)
+        self.downloadMeta = {}
+        self.errors = []
+
+    def run(self, **args):
+        """
+        Run the pipeline for a search with the same parameters as M2M.iterScenes.
+
+        :return: dictionary with metadata from all scenes
+        """
+        self.pool = DownloadPool(self.downloadMeta, self.m2m.session, max_workers=self.downloadWorkers,
+                                 controller=self.m2m.downloadController, postProcessor=self.m2m.postProcessor,
+                                 metrics=self.m2m.metrics, **self.m2m.poolOptions)
+        workers = [threading.Thread(target=self.orderWorker, daemon=True) for _ in range(self.orderWorkers)]
+        for worker in workers:
+            worker.start()
+        try:
+            batch = []
+            nBatch = 0
+            for scene in self.m2m.iterScenes(self.datasetName, pageSize=self.pageSize, **args):
+                if len(self.errors):
+                    break
+                batch.append(scene['entityId'])
+                if len(batch) == self.batchSize:
+                    self.orderQueue.put(('{}_{}'.format(self.label, nBatch), batch))
+                    batch = []
+                    nBatch += 1
+            if len(batch) and not len(self.errors):
+                self.orderQueue.put(('{}_{}'.format(self.label, nBatch), batch))
+        finally:
+            for worker in workers:
+                self.orderQueue.put(None)
+            for worker in workers:
+                worker.join()
+            self.pool.wait()
+        if len(self.errors):
+            raise self.errors[0]
+        logging.info('Pipeline.run - {} scenes processed'.format(len(self.downloadMeta)))
+        return self.downloadMeta
+
+    def orderWorker(self):
+        while True:
+            item = self.orderQueue.get()
+            if item is None:
+                break
+            if len(self.errors):
+                continue
+            label, entityIds = item
+            batch = Batch(self, label)
+            labels = []
+            try:
+                logging.info('Pipeline.orderWorker - ordering {} scenes with label {}'.format(len(entityIds), label))
+                self.m2m.orderScenes(self.datasetName, entityIds, batch, self.downloadMeta, self.filterOptions, label,
+                                     labels=labels)
+            except Exception as e:
+                logging.error('Pipeline.orderWorker - order {} failed: {}'.format(label, e))
+                self.errors.append(e)
+                batch.failed = True
+            batch.ordered(labels)
+
+    def finishBatch(self, batch):
+        """
+        Remove the orders of a batch once it is ordered and all its downloads finished, and mark
+        its job complete in the journal if no download failed, so it can be resumed otherwise.
+        """
+        for lb in batch.labels or [batch.label]:
+            try:
+                self.m2m.downloadOrderRemove(lb)
+            except Exception as e:
+                logging.warning('Pipeline.finishBatch - not able to remove order {}: {}'.format(lb, e))
+        if len(batch.labels) and not batch.failed and self.m2m.journal is not None:
+            self.m2m.journal.completeJob(batch.label)
+
+    def submit(self, download):
+        """
+        Submit a download to the download pool, waiting while the pool is full.
+        """
+        self.downloadSlots.acquire()
+        idD = str(download['downloadId'])
+        try:
+            future = self.pool.submit(download)
+        except Exception:
+            self.downloadSlots.release()
+            raise
+        if future is None:
+            self.downloaded(idD)
+        else:
+            future.add_done_callback(lambda f: self.downloaded(idD, f))
+        return future
+
+    def downloaded(self, idD, future=None):
+        self.downloadSlots.release()
+        if future is not None and future.exception() is not None:
+            logging.error('Pipeline.downloaded - download {} failed: {}'.format(idD, future.exception()))
+            self.downloadMeta[idD]['error'] = str(future.exception())
+            return
+        if self.callback is not None:
+            try:
+                self.callback(idD, self.downloadMeta[idD])
+            except Exception as e:
+                logging.error('Pipeline.downloaded - callback failed for download {}: {}'.format(idD, e))
+                self.errors.append(e)
+
+class Batch(object):
+    """
+    Downloads of an order batch, passed to M2M.orderScenes as its pool. The batch is finished
+    by the pipeline when it is ordered and the last of its downloads finished.
+    """
+
+    def __init__(self, pipeline, label):
+        self.pipeline = pipeline
+        self.label = label
+        self.labels = []
+        self.failed = False
+        self.lock = threading.Lock()
+        # the ordering counts as a pending task
+        self.pending = 1
+
+    def submit(self, download):
+        with self.lock:
+            self.pending += 1
+        try:
+            future = self.pipeline.submit(download)
+        except Exception:
+            self.release()
+            raise
+        if future is None:
+            self.release()
+        else:
+            future.add_done_callback(self.release)
+        return future
+
+    def ordered(self, labels):
+        self.labels = labels
+        self.release()
+
+    def release(self, future=None):
+        with self.lock:
+            if future is not None and future.exception() is not None:
+                self.failed = True
+            self.pending -= 1
+            finished = self.pending == 0
+        if finished:
+            self.pipeline.finishBatch(self)
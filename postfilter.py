@@ -0,0 +1,153 @@
+import logging
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from filters import Filter, FilterError
+from geometry import STRtree, polygons, area, bounds, convex_rings, intersection_areas
+from results import ranges
+
+class SceneFilter(object):
+    """Vectorized client-side filter of the scenes of a results.SceneTable (requires the numpy package).
+
+    The bounding boxes of the footprints are indexed in an STR-packed R-tree, so geometry
+    predicates only compute the exact intersections of the candidate scenes:
+
+        sceneFilter = SceneFilter(m2m.searchTable('landsat_ot_c2_l1', geoJsonPath='geojson/california.geojson'))
+        table = sceneFilter.apply(geoJsonPath='geojson/california.geojson', minCoverage=.5, maxCC=20)
+    """
+
+    def __init__(self, table, nodeSize=16):
+        """
+        :param table: results.SceneTable
+        :param nodeSize: maximum number of children of every node of the spatial index
+        """
+        if np is None:
+            raise FilterError("SceneFilter requires the numpy package")
+        self.table = table
+        self.index = STRtree(table['minLon'], table['minLat'], table['maxLon'], table['maxLat'], nodeSize)
+
+    def candidates(self, polys):
+        """Rows of the scenes whose bounding box intersects the bounding box of some polygons."""
+        return self.index.query(*bounds(polys))
+
+    def intersectionAreas(self, polys, rows):
+        """Areas of the intersection of the footprints of some rows with some polygons, in square degrees."""
+        table = self.table
+        nRings = table.sceneOffsets[rows + 1] - table.sceneOffsets[rows]
+        rings = ranges(table.sceneOffsets[rows], nRings)
+        if not len(rings):
+            return np.zeros(len(rows))
+        ringAreas = intersection_areas(convex_rings(table.coords, table.ringOffsets, rings), polys)
+        return np.bincount(np.repeat(np.arange(len(rows)), nRings), weights=ringAreas, minlength=len(rows))
+
+    def footprintAreas(self, rows):
+        """Areas of the footprints of some rows, in square degrees."""
+        table = self.table
+        nRings = table.sceneOffsets[rows + 1] - table.sceneOffsets[rows]
+        rings = ranges(table.sceneOffsets[rows], nRings)
+        if not len(rings):
+            return np.zeros(len(rows))
+        padded = convex_rings(table.coords, table.ringOffsets, rings)
+        x, y = padded[..., 0], padded[..., 1]
+        ringAreas = .5 * np.sum(x[:, :-1] * y[:, 1:] - x[:, 1:] * y[:, :-1], axis=1)
+        return np.bincount(np.repeat(np.arange(len(rows)), nRings), weights=ringAreas, minlength=len(rows))
+
+    def coverage(self, geoJson):
+        """Fraction of the area of a geometry covered by the footprint of every scene.
+
+        :param geoJson: GeoJSON geometry
+        :return: array with the coverage of every row of the table
+        """
+        polys = polygons(geoJson)
+        result = np.zeros(len(self.table))
+        rows = self.candidates(polys)
+        if len(rows):
+            result[rows] = self.intersectionAreas(polys, rows) / area(polys)
+        return np.clip(result, 0., 1.)
+
+    def overlap(self, geoJson):
+        """Fraction of the footprint of every scene inside a geometry.
+
+        :param geoJson: GeoJSON geometry
+        :return: array with the overlap of every row of the table
+        """
+        polys = polygons(geoJson)
+        result = np.zeros(len(self.table))
+        rows = self.candidates(polys)
+        if len(rows):
+            footprints = self.footprintAreas(rows)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                result[rows] = np.nan_to_num(self.intersectionAreas(polys, rows) / footprints)
+        return np.clip(result, 0., 1.)
+
+    def mask(self, boundingBox=None, geoJsonType=None, geoJsonCoords=None, geoJsonPath=None, minCoverage=None,
+             minOverlap=None, minCC=None, maxCC=None, includeUnknownCC=True, startDate=None, endDate=None, months=None):
+        """Boolean mask of the scenes satisfying all the predicates.
+
+        The spatial and cloud cover parameters are the same as in searchScenes. Without minCoverage
+        or minOverlap, the footprints only need to intersect the geometry.
+
+        :param minCoverage: minimum fraction of the geometry covered by the scene
+        :param minOverlap: minimum fraction of the scene inside the geometry
+        :param startDate: minimum start date of the acquisition (YYYY-MM-DD)
+        :param endDate: maximum start date of the acquisition (YYYY-MM-DD), inclusive
+        :param months: list of acquisition months (1 to 12)
+        :return: boolean array
+        """
+        table = self.table
+        mask = np.ones(len(table), dtype=bool)
+        cloudCover = table['cloudCover']
+        unknown = np.isnan(cloudCover)
+        with np.errstate(invalid='ignore'):
+            if minCC is not None:
+                mask &= (cloudCover >= minCC) | (unknown & includeUnknownCC)
+            if maxCC is not None:
+                mask &= (cloudCover <= maxCC) | (unknown & includeUnknownCC)
+        if not includeUnknownCC:
+            mask &= ~unknown
+        dates = table['startDate']
+        if startDate is not None:
+            mask &= dates >= np.datetime64(startDate)
+        if endDate is not None:
+            mask &= dates < np.datetime64(endDate, 'D') + np.timedelta64(1, 'D')
+        if months is not None:
+            mask &= np.isin(dates.astype('datetime64[M]').astype(np.int64) % 12 + 1, months)
+        spatialFilter = Filter.spatialFilter(boundingBox, geoJsonType, geoJsonCoords, geoJsonPath).get('spatialFilter')
+        if spatialFilter is not None:
+            mask &= self.spatialMask(spatialFilter, mask, minCoverage, minOverlap)
+        logging.info('SceneFilter.mask - {} of {} scenes selected'.format(int(mask.sum()), len(table)))
+        return mask
+
+    def spatialMask(self, spatialFilter, mask, minCoverage=None, minOverlap=None):
+        if spatialFilter['filterType'] == 'mbr':
+            ll, ur = spatialFilter['lowerLeft'], spatialFilter['upperRight']
+            x0, y0, x1, y1 = ll['longitude'], ll['latitude'], ur['longitude'], ur['latitude']
+            geoJson = {'type': 'Polygon', 'coordinates': [[[x0, y0], [x1, y0], [x1, y1], [x0, y1], [x0, y0]]]}
+        else:
+            geoJson = spatialFilter['geoJson']
+        polys = polygons(geoJson)
+        rows = self.candidates(polys)
+        rows = rows[mask[rows]]
+        result = np.zeros(len(self.table), dtype=bool)
+        if not len(rows):
+            return result
+        areas = self.intersectionAreas(polys, rows)
+        selected = areas > 0
+        if minCoverage is not None:
+            selected &= areas / area(polys) >= minCoverage
+        if minOverlap is not None:
+            footprints = self.footprintAreas(rows)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                selected &= np.nan_to_num(areas / footprints) >= minOverlap
+        result[rows[selected]] = True
+        return result
+
+    def apply(self, **predicates):
+        """Table with the scenes satisfying the predicates of mask.
+
+        :return: results.SceneTable
+        """
+        return self.table[self.mask(**predicates)]
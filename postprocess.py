@@ -0,0 +1,126 @@
+import concurrent.futures
+import fnmatch
+import hashlib
+import logging
+import multiprocessing
+import os
+import tarfile
+import os.path as osp
+
+block_size = 8 * 1024 * 1024
+extract_filter = {'filter': 'data'} if hasattr(tarfile, 'data_filter') else {}
+# the workers are started while download threads are running, so they must not be forked
+start_method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+
+class PostProcessor(object):
+    """
+    Pool of worker processes for the CPU-bound work after a scene is downloaded: hashing the
+    file and extracting the tar file, optionally only the members matching some patterns.
+
+    The workers are started with forkserver, or spawn where not available, so they import the
+    __main__ module of the caller again: scripts using a PostProcessor must run under
+    if __name__ == '__main__':, otherwise every worker runs the script again.
+    """
+
+    def __init__(self, workers=None, hashAlgorithm='sha256', extract=False, extractPath=None,
+                 members=None, removeTar=False):
+        """
+        :param workers: number of worker processes, number of CPUs by default
+        :param hashAlgorithm: hashlib algorithm used to hash the file, None to not hash it
+        :param extract: extract the tar file
+        :param extractPath: directory where every scene is extracted into a subdirectory, next to the tar file by default
+        :param members: list of glob patterns of the members to extract (bands for instance '*_B4.TIF'), all by default
+        :param removeTar: remove the tar file after extracting it
+        """
+        self.workers = workers
+        self.hashAlgorithm = hashAlgorithm
+        self.extract = extract
+        self.extractPath = extractPath
+        self.members = members
+        self.removeTar = removeTar
+        self.executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+
+    def submit(self, local_path):
+        """
+        Submit a downloaded file to the worker processes.
+
+        :param local_path: path to the downloaded file
+        :return: future with the dictionary of results
+        """
+        if self.executor is None:
+            self.executor = concurrent.futures.ProcessPoolExecutor(max_workers=self.workers,
+                                                                   mp_context=multiprocessing.get_context(start_method))
+        extractPath = None
+        if self.extract:
+            extractPath = osp.join(self.extractPath or osp.dirname(local_path), osp.basename(local_path).split('.')[0])
+        return self.executor.submit(process_file, local_path, self.hashAlgorithm, extractPath, self.members, self.removeTar)
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+            self.executor = None
+
+def process_file(local_path, hashAlgorithm='sha256', extractPath=None, members=None, removeTar=False):
+    """
+    Hash and extract a downloaded file.
+
+    :param local_path: path to the downloaded file
+    :param hashAlgorithm: hashlib algorithm used to hash the file, None to not hash it
+    :param extractPath: directory where the tar file is extracted, None to not extract it
+    :param members: list of glob patterns of the members to extract, all by default
+    :param removeTar: remove the tar file after extracting it
+    :return: dictionary with the checksum and the extracted files
+    """
+    result = {}
+    if hashAlgorithm is not None:
+        result['checksum'] = hash_file(local_path, hashAlgorithm)
+        result['hashAlgorithm'] = hashAlgorithm
+    if extractPath is not None:
+        result['extracted'] = extract_tar(local_path, extractPath, members)
+        if removeTar:
+            os.remove(local_path)
+    return result
+
+def hash_file(path, hashAlgorithm='sha256'):
+    """
+    Hash a file reading it in blocks.
+
+    :param path: path to the file
+    :param hashAlgorithm: hashlib algorithm
+    :return: hexadecimal digest
+    """
+    h = hashlib.new(hashAlgorithm)
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            h.update(block)
+    return h.hexdigest()
+
+def extract_tar(path, extractPath, members=None):
+    """
+    Extract the members of a tar file matching some patterns.
+
+    :param path: path to the tar file
+    :param extractPath: directory where the members are extracted
+    :param members: list of glob patterns of the members to extract, all by default
+    :return: list of paths of the extracted files
+    """
+    extracted = []
+    with tarfile.open(path) as tar:
+        for member in tar:
+            if not member.isfile() or not matches(member.name, members):
+                continue
+            tar.extract(member, extractPath, set_attrs=False, **extract_filter)
+            extracted.append(osp.join(extractPath, member.name))
+    logging.info('extract_tar - {} files extracted from {}'.format(len(extracted), path))
+    return extracted
+
+def matches(name, members):
+    if members is None:
+        return True
+    return any(fnmatch.fnmatch(osp.basename(name), pattern) for pattern in members)
@@ -0,0 +1,292 @@
+import datetime
+import logging
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from api import M2MError
+
+chunk_rows = 10000
+float_columns = ['cloudCover', 'minLon', 'minLat', 'maxLon', 'maxLat']
+date_columns = ['startDate', 'endDate']
+
+class SceneTable(object):
+    """Compact columnar container of scene search results (requires the numpy package).
+
+    Every scene is a row and the commonly used fields are stored in column arrays: entityId,
+    displayId, cloudCover (NaN if unknown), startDate and endDate (datetime64 in UTC), the spatial
+    bounds minLon, minLat, maxLon and maxLat, and the footprint exterior rings stored as in Arrow,
+    as coordinates with offsets of the rings of every scene and of every ring.
+
+    Columns are accessed as table['cloudCover'], and rows are selected by a boolean mask, an
+    array of indices or a slice, so filtering is vectorized:
+
+        table = m2m.searchTable('landsat_ot_c2_l1', **params)
+        clear = table[table['cloudCover'] < 20].sort('startDate')
+    """
+
+    def __init__(self, columns, coords=None, ringOffsets=None, sceneOffsets=None):
+        """
+        :param columns: dictionary of column arrays with the same length
+        :param coords: array of (longitude, latitude) coordinates of all the footprint rings
+        :param ringOffsets: array of the offsets of every ring in coords
+        :param sceneOffsets: array of the offsets of the rings of every scene in ringOffsets
+        """
+        if np is None:
+            raise M2MError("SceneTable requires the numpy package")
+        self.columns = columns
+        n = len(columns['entityId'])
+        self.coords = np.zeros((0, 2)) if coords is None else coords
+        self.ringOffsets = np.zeros(1, dtype=np.int64) if ringOffsets is None else ringOffsets
+        self.sceneOffsets = np.zeros(n + 1, dtype=np.int64) if sceneOffsets is None else sceneOffsets
+
+    @classmethod
+    def fromScenes(cls, scenes, fields=[]):
+        """Build a table from the results of searchScenes or from an iterable of scenes like iterScenes.
+
+        The scenes are converted to arrays every chunk_rows scenes, so the dictionaries of an
+        iterable are not kept in memory.
+
+        :param scenes: dictionary returned by searchScenes or iterable of scene dictionaries
+        :param fields: other scene keys stored as columns
+        :return: SceneTable object
+        """
+        if np is None:
+            raise M2MError("SceneTable requires the numpy package")
+        if isinstance(scenes, dict):
+            scenes = scenes['results']
+        builder = TableBuilder(fields)
+        for scene in scenes:
+            builder.append(scene)
+        return builder.build()
+
+    def __len__(self):
+        return len(self.columns['entityId'])
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            return self.columns[key]
+        return self.take(key)
+
+    def __repr__(self):
+        return 'SceneTable({} scenes, columns={})'.format(len(self), list(self.columns))
+
+    def take(self, rows):
+        """Select rows of the table.
+
+        :param rows: boolean mask, array of indices or slice
+        :return: new SceneTable with the rows selected
+        """
+        indices = np.arange(len(self))[rows]
+        columns = {name: column[indices] for name,column in self.columns.items()}
+        rings = self.sceneOffsets[indices + 1] - self.sceneOffsets[indices]
+        sceneOffsets = np.concatenate([[0], np.cumsum(rings)]).astype(np.int64)
+        ringIndices = ranges(self.sceneOffsets[indices], rings)
+        points = self.ringOffsets[ringIndices + 1] - self.ringOffsets[ringIndices]
+        ringOffsets = np.concatenate([[0], np.cumsum(points)]).astype(np.int64)
+        coords = self.coords[ranges(self.ringOffsets[ringIndices], points)]
+        return SceneTable(columns, coords, ringOffsets, sceneOffsets)
+
+    def filter(self, **predicates):
+        """Select the rows where every column satisfies its predicate, a function applied to the whole column.
+
+            table.filter(cloudCover=lambda cc: cc < 20, displayId=lambda ids: np.char.startswith(ids, 'LC08'))
+
+        :return: new SceneTable with the rows selected
+        """
+        mask = np.ones(len(self), dtype=bool)
+        for name,predicate in predicates.items():
+            mask &= np.asarray(predicate(self.columns[name]), dtype=bool)
+        return self.take(mask)
+
+    def sort(self, *names, descending=False):
+        """Sort the rows by some columns, the first one being the primary key.
+
+        :return: new SceneTable sorted
+        """
+        order = np.lexsort([self.columns[name] for name in reversed(names)])
+        if descending:
+            order = order[::-1]
+        return self.take(order)
+
+    def footprint(self, row):
+        """Exterior rings of the footprint of a scene.
+
+        :param row: index of the scene
+        :return: list of arrays of (longitude, latitude) coordinates
+        """
+        return [self.coords[self.ringOffsets[ring]:self.ringOffsets[ring + 1]]
+                for ring in range(self.sceneOffsets[row], self.sceneOffsets[row + 1])]
+
+    def toScenes(self):
+        """Dictionary like the one returned by searchScenes with the scalar columns, so it can be
+        passed to retrieveScenes.
+        """
+        names = list(self.columns)
+        results = [dict(zip(names, values)) for values in zip(*[self.columns[name].tolist() for name in names])]
+        return {'results': results, 'recordsReturned': len(results), 'totalHits': len(results)}
+
+    def toArrow(self):
+        """Convert the table to a pyarrow.Table (requires the pyarrow package), the footprints are stored
+        in the column footprint as lists of rings of (longitude, latitude) coordinates.
+        """
+        try:
+            import pyarrow as pa
+        except ImportError:
+            raise M2MError("SceneTable.toArrow requires the pyarrow package")
+        arrays = {name: pa.array(column) for name,column in self.columns.items()}
+        points = pa.FixedSizeListArray.from_arrays(pa.array(self.coords.ravel()), 2)
+        rings = pa.ListArray.from_arrays(pa.array(self.ringOffsets.astype(np.int32)), points)
+        arrays['footprint'] = pa.ListArray.from_arrays(pa.array(self.sceneOffsets.astype(np.int32)), rings)
+        return pa.table(arrays)
+
+    def toParquet(self, path, **options):
+        """Write the table to a Parquet file (requires the pyarrow package).
+
+        :param path: path to the Parquet file
+        :param options: options of pyarrow.parquet.write_table
+        """
+        try:
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise M2MError("SceneTable.toParquet requires the pyarrow package")
+        pq.write_table(self.toArrow(), path, **options)
+
+    @classmethod
+    def concatenate(cls, tables):
+        """Concatenate several tables with the same columns.
+
+        :param tables: list of SceneTable objects
+        :return: SceneTable object
+        """
+        tables = [table for table in tables if len(table)]
+        if not len(tables):
+            return TableBuilder().build()
+        columns = {name: np.concatenate([table.columns[name] for table in tables]) for name in tables[0].columns}
+        coords = np.concatenate([table.coords for table in tables])
+        ringOffsets, sceneOffsets = [np.zeros(1, dtype=np.int64)], [np.zeros(1, dtype=np.int64)]
+        nCoords, nRings = 0, 0
+        for table in tables:
+            ringOffsets.append(table.ringOffsets[1:] + nCoords)
+            sceneOffsets.append(table.sceneOffsets[1:] + nRings)
+            nCoords += len(table.coords)
+            nRings += len(table.ringOffsets) - 1
+        return cls(columns, coords, np.concatenate(ringOffsets), np.concatenate(sceneOffsets))
+
+class TableBuilder(object):
+    """
+    Build a SceneTable appending scenes, converted to arrays every chunk_rows scenes.
+    """
+
+    def __init__(self, fields=[]):
+        self.fields = list(fields)
+        self.chunks = []
+        self.reset()
+
+    def reset(self):
+        self.rows = {name: [] for name in ['entityId', 'displayId'] + float_columns + date_columns + self.fields}
+        self.coords = []
+        self.ringSizes = []
+        self.sceneRings = []
+
+    def append(self, scene):
+        rows = self.rows
+        rows['entityId'].append(scene.get('entityId') or '')
+        rows['displayId'].append(scene.get('displayId') or '')
+        rows['cloudCover'].append(parse_float(scene.get('cloudCover')))
+        temporalCoverage = scene.get('temporalCoverage') or {}
+        rows['startDate'].append(parse_date(temporalCoverage.get('startDate')))
+        rows['endDate'].append(parse_date(temporalCoverage.get('endDate')))
+        for name in self.fields:
+            rows[name].append(scene.get(name))
+        rings = exterior_rings(scene.get('spatialCoverage') or scene.get('spatialBounds'))
+        if len(rings):
+            points = [point for ring in rings for point in ring]
+            lons, lats = [p[0] for p in points], [p[1] for p in points]
+            bounds = [min(lons), min(lats), max(lons), max(lats)]
+        else:
+            bounds = [float('nan')] * 4
+        for name,value in zip(['minLon', 'minLat', 'maxLon', 'maxLat'], bounds):
+            rows[name].append(value)
+        for ring in rings:
+            self.coords.extend((float(p[0]), float(p[1])) for p in ring)
+            self.ringSizes.append(len(ring))
+        self.sceneRings.append(len(rings))
+        if len(rows['entityId']) >= chunk_rows:
+            self.flush()
+
+    def flush(self):
+        if not len(self.rows['entityId']):
+            return
+        columns = {}
+        for name,values in self.rows.items():
+            if name in float_columns:
+                columns[name] = np.array(values, dtype=np.float64)
+            elif name in date_columns:
+                columns[name] = np.array(values, dtype='datetime64[s]')
+            elif name in ('entityId', 'displayId'):
+                columns[name] = np.array(values, dtype=str)
+            else:
+                columns[name] = np.array(values)
+        coords = np.array(self.coords, dtype=np.float64).reshape(-1, 2)
+        ringOffsets = np.concatenate([[0], np.cumsum(self.ringSizes, dtype=np.int64)]).astype(np.int64)
+        sceneOffsets = np.concatenate([[0], np.cumsum(self.sceneRings, dtype=np.int64)]).astype(np.int64)
+        self.chunks.append(SceneTable(columns, coords, ringOffsets, sceneOffsets))
+        self.reset()
+
+    def build(self):
+        self.flush()
+        if len(self.chunks) == 1:
+            table = self.chunks[0]
+        elif len(self.chunks):
+            table = SceneTable.concatenate(self.chunks)
+        else:
+            columns = {name: np.array([], dtype=np.float64 if name in float_columns else 'datetime64[s]' if name in date_columns else str)
+                       for name in self.rows}
+            table = SceneTable(columns)
+        self.chunks = []
+        logging.info('TableBuilder.build - table with {} scenes'.format(len(table)))
+        return table
+
+def ranges(starts, lengths):
+    """
+    Concatenation of the ranges of indices [start, start+length) without a Python loop.
+    """
+    total = int(lengths.sum())
+    if total == 0:
+        return np.zeros(0, dtype=np.int64)
+    repeated = np.repeat(starts - np.concatenate([[0], np.cumsum(lengths)[:-1]]), lengths)
+    return repeated + np.arange(total)
+
+def exterior_rings(geometry):
+    if not geometry:
+        return []
+    if geometry.get('type') == 'Polygon':
+        return geometry['coordinates'][:1]
+    if geometry.get('type') == 'MultiPolygon':
+        return [polygon[0] for polygon in geometry['coordinates']]
+    return []
+
+def parse_float(value):
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        return float('nan')
+    return float('nan') if value < 0 else value
+
+def parse_date(value):
+    """
+    Parse an M2M date like '2020-08-01 00:00:00-05' into a naive UTC datetime, None if not available.
+    """
+    if not value:
+        return None
+    value = value.strip().replace(' ', 'T', 1)
+    if len(value) > 19 and value[19] in '+-':
+        offset = value[20:].replace(':', '')
+        value = value[:20] + offset[:2] + ':' + offset[2:].ljust(2, '0')
+    date = datetime.datetime.fromisoformat(value)
+    if date.tzinfo is not None:
+        date = date.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return date
@@ -0,0 +1,229 @@
+"""
+Benchmarks of searchScenes, retrieveScenes and download_scenes against the local mock server.
+
+Every scenario reports its throughput, the p50/p99 latencies recorded by metrics.Metrics and
+the peak RSS of the process as JSON. The memory scenario downloads one --large-size file to
+check that the RSS does not grow with it, and the session, shards and geojson scenarios compare
+variants of the same searches: a pooled session against a new connection per request, a single
+search against time and space shards, and a raw GeoJSON spatial filter against simplified ones. The mock server runs in a separate process, so only the
+client is measured. Without --scenario, every scenario runs in its own process so the peak RSS
+of one does not hide the others:
+
+    python tests/benchmark.py --scenes 2000 --latency 0.05 --error-rate 0.01 --prep-delay 2
+    python tests/benchmark.py --scenario download --file-size 50000000 --bandwidth 20000000
+    python tests/benchmark.py --scenario memory --large-size 4000000000
+"""
+import argparse
+import json
+import logging
+import os.path as osp
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, osp.dirname(osp.dirname(osp.abspath(__file__))))
+
+import requests
+
+import api
+import downloader
+from api import M2M
+from metrics import Metrics
+from mock_server import MockProcess, scene
+
+scenarios = ['search', 'iterate', 'retrieve', 'download', 'memory', 'session', 'shards', 'geojson']
+datasetName = 'landsat_ot_c2_l1'
+# acquisition dates and bounding box of all the mock scenes
+startDate, endDate = '2020-08-01', '2020-08-28'
+boundingBox = (-125., -112., 32., 43.)
+geoJsonPath = 'geojson/california.geojson'
+
+def peak_rss():
+    """Peak resident set size of the process in MB."""
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 1024. ** 2 if sys.platform == 'darwin' else rss / 1024.
+
+def latencies(metrics, names):
+    histograms = metrics.snapshot()['histograms']
+    return {key: {stat: histogram[stat] for stat in ('count', 'p50', 'p99', 'max')}
+            for key,histogram in histograms.items() if key.split('{')[0] in names}
+
+def search_latency(metrics):
+    """Statistics of the scene-search requests recorded in metrics."""
+    histograms = metrics.snapshot()['histograms']
+    histogram = histograms['m2m_request_seconds{endpoint="scene-search"}']
+    return {stat: histogram[stat] for stat in ('count', 'p50', 'p99', 'max')}
+
+def new_m2m(server, options, metrics):
+    api.M2M_ENDPOINT = server.endpoint
+    api.POLL_MIN_SECONDS = options.poll
+    return M2M('benchmark', 'benchmark', requestRate=options.request_rate, metrics=metrics,
+               maxDownloads=options.workers, batchSize=options.batch_size, cacheApiKey=False)
+
+def search(server, options, metrics):
+    """Repeated searches of pageSize scenes."""
+    m2m = new_m2m(server, options, metrics)
+    nScenes = 0
+    for _ in range(options.repeat):
+        nScenes += m2m.searchScenes(datasetName, maxResults=options.page_size)['recordsReturned']
+    return {'scenes': nScenes}, ['m2m_request_seconds']
+
+def iterate(server, options, metrics):
+    """Search of all the scenes page by page."""
+    m2m = new_m2m(server, options, metrics)
+    nScenes = sum(1 for _ in m2m.iterScenes(datasetName, pageSize=options.page_size))
+    return {'scenes': nScenes}, ['m2m_request_seconds']
+
+def retrieve(server, options, metrics):
+    """Order and download of all the scenes.
+
+    The scenes of the first batch are ordered before with another label, so the batches of the
+    download request return duplicateProducts as a dictionary in the first one and as [] in the
+    others, and all the scenes must be retrieved.
+    """
+    m2m = new_m2m(server, options, metrics)
+    scenes = m2m.searchScenes(datasetName, maxResults=options.scenes)
+    m2m.downloadRequest([{'entityId': scene['entityId'], 'productId': 'P' + scene['entityId']}
+                         for scene in scenes['results'][:options.batch_size]], label='benchmark_duplicates')
+    downloadMeta = m2m.retrieveScenes(datasetName, scenes)
+    if len(downloadMeta) != scenes['recordsReturned']:
+        raise RuntimeError('{} scenes retrieved out of {}'.format(len(downloadMeta), scenes['recordsReturned']))
+    return {'scenes': len(downloadMeta), 'bytes': len(downloadMeta) * options.file_size}, \
+           ['m2m_request_seconds', 'download_preparation_seconds', 'download_seconds']
+
+def download(server, options, metrics):
+    """Download of all the scene files, without M2M requests."""
+    downloads = [server.download(k) for k in range(options.scenes)]
+    downloadMeta = {str(d['downloadId']): {'displayId': scene(d['downloadId'])['displayId']} for d in downloads}
+    downloader.download_scenes(downloads, downloadMeta, metrics=metrics)
+    return {'scenes': len(downloads), 'bytes': len(downloads) * options.file_size}, ['download_seconds']
+
+def memory(server, options, metrics):
+    """Download of one --large-size file, whose peak RSS should not depend on the file size."""
+    downloads = [server.download(0)]
+    downloadMeta = {'0': {'displayId': scene(0)['displayId']}}
+    rss = peak_rss()
+    downloader.download_scenes(downloads, downloadMeta, metrics=metrics)
+    return {'scenes': 1, 'bytes': options.large_size, 'peak_rss_before_mb': rss}, ['download_seconds']
+
+def session(server, options, metrics):
+    """Searches with the pooled keep-alive session against a new connection per request."""
+    variants = {}
+    for variant in ('pooled', 'per_request'):
+        variantMetrics = Metrics()
+        m2m = new_m2m(server, options, variantMetrics)
+        if variant == 'per_request':
+            m2m._session = requests
+        start = time.monotonic()
+        for _ in range(options.repeat):
+            m2m.searchScenes(datasetName, maxResults=options.page_size)
+        variants[variant] = {'seconds': time.monotonic() - start, 'latency': search_latency(variantMetrics)}
+    return {'scenes': 2 * options.repeat * min(options.page_size, options.scenes), 'variants': variants}, []
+
+def shards(server, options, metrics):
+    """Search of all the scenes in a single request against time and space shards."""
+    variants = {}
+    for variant,(timeShards,spaceShards) in (('single', (1, 1)), ('sharded', (options.time_shards, options.space_shards))):
+        variantMetrics = Metrics()
+        m2m = new_m2m(server, options, variantMetrics)
+        start = time.monotonic()
+        scenes = m2m.searchScenes(datasetName, timeShards=timeShards, spaceShards=spaceShards, startDate=startDate,
+                                  endDate=endDate, boundingBox=boundingBox, maxResults=options.scenes)
+        variants[variant] = {'seconds': time.monotonic() - start, 'scenes': scenes['recordsReturned'],
+                             'latency': search_latency(variantMetrics)}
+    return {'scenes': sum(variant['scenes'] for variant in variants.values()), 'variants': variants}, []
+
+def geojson(server, options, metrics):
+    """Searches with the raw GeoJSON spatial filter against the ones simplified with geoJsonTolerance."""
+    variants = {}
+    for tolerance in (None, .01, .1):
+        variantMetrics = Metrics()
+        m2m = new_m2m(server, options, variantMetrics)
+        for _ in range(options.repeat):
+            m2m.searchScenes(datasetName, geoJsonPath=geoJsonPath, geoJsonTolerance=tolerance, maxResults=options.page_size)
+        requestBytes = variantMetrics.snapshot()['histograms']['m2m_request_bytes{endpoint="scene-search"}']
+        variants['raw' if tolerance is None else 'tolerance_{}'.format(tolerance)] = {
+            'request_bytes': requestBytes['sum'] / requestBytes['count'],
+            'latency': search_latency(variantMetrics)
+        }
+    return {'scenes': 3 * options.repeat * min(options.page_size, options.scenes), 'variants': variants}, []
+
+def run(scenario, options):
+    """
+    Run a scenario against a new mock server.
+
+    :return: dictionary with the results of the scenario
+    """
+    acqPath = tempfile.mkdtemp(prefix='m2m-benchmark_')
+    downloader.ACQ_PATH = acqPath
+    # the disk cache of the M2M objects must not mix mock responses with the real ones
+    api.CONFIG_PATH = osp.join(acqPath, 'config')
+    downloader.download_sleep_seconds = 0
+    metrics = Metrics()
+    try:
+        with MockProcess(scenes=options.scenes, fileSize=options.large_size if scenario == 'memory' else options.file_size,
+                         latency=options.latency, jitter=options.jitter, errorRate=options.error_rate,
+                         prepDelay=options.prep_delay, bandwidth=options.bandwidth,
+                         resultLatency=options.result_latency if scenario == 'shards' else 0.) as server:
+            start = time.monotonic()
+            result, names = globals()[scenario](server, options, metrics)
+            seconds = time.monotonic() - start
+            requests = server.requestCounts()
+    finally:
+        shutil.rmtree(acqPath, ignore_errors=True)
+    result.update({
+        'scenario': scenario,
+        'seconds': seconds,
+        'scenes_per_second': result['scenes'] / seconds,
+        'requests': requests,
+        'latency': latencies(metrics, names),
+        'peak_rss_mb': peak_rss()
+    })
+    if 'bytes' in result:
+        result['mb_per_second'] = result['bytes'] / seconds / 1024. ** 2
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description='M2M benchmarks against a local mock server')
+    parser.add_argument('--scenario', choices=scenarios, help='scenario to run, all in subprocesses by default')
+    parser.add_argument('--scenes', type=int, default=500)
+    parser.add_argument('--file-size', type=int, default=1024*1024)
+    parser.add_argument('--latency', type=float, default=.02)
+    parser.add_argument('--jitter', type=float, default=0.)
+    parser.add_argument('--error-rate', type=float, default=0.)
+    parser.add_argument('--prep-delay', type=float, default=1.)
+    parser.add_argument('--bandwidth', type=float, default=None, help='bytes per second of every file transfer')
+    parser.add_argument('--large-size', type=int, default=2*1024**3, help='bytes of the file of the memory scenario')
+    parser.add_argument('--result-latency', type=float, default=.001,
+                        help='seconds of the mock server per scene returned in the shards scenario')
+    parser.add_argument('--time-shards', type=int, default=4)
+    parser.add_argument('--space-shards', type=int, default=2)
+    parser.add_argument('--page-size', type=int, default=100)
+    parser.add_argument('--batch-size', type=int, default=100, help='elements of every M2M batch request')
+    parser.add_argument('--repeat', type=int, default=20, help='number of searches of the search, session and geojson scenarios')
+    parser.add_argument('--workers', type=int, default=downloader.max_threads)
+    parser.add_argument('--request-rate', type=float, default=None, help='M2M requests per second, unlimited by default')
+    parser.add_argument('--poll', type=float, default=.5, help='initial seconds between download-retrieve requests')
+    parser.add_argument('--output', help='JSON file with the results')
+    options = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(levelname)s - %(message)s')
+    if options.scenario is not None:
+        results = [run(options.scenario, options)]
+    else:
+        results = []
+        for scenario in scenarios:
+            args = [a for k,a in enumerate(sys.argv[1:]) if not a.startswith('--output') and sys.argv[k] != '--output']
+            output = subprocess.run([sys.executable, osp.abspath(__file__), '--scenario', scenario] + args,
+                                    check=True, stdout=subprocess.PIPE).stdout
+            results.extend(json.loads(output))
+    text = json.dumps(results, indent=2)
+    if options.output is not None:
+        with open(options.output, 'w') as f:
+            f.write(text)
+    print(text)
+
+if __name__ == '__main__':
+    main()
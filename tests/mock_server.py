@@ -0,0 +1,396 @@
+"""
+Local stand-in for the M2M USGS API and its download servers, used by the benchmarks.
+
+It implements the JSON endpoints used by M2M (login, login-token, logout, dataset-search,
+permissions, dataset-filters, scene-search, scene-list-add, scene-list-remove, download-options,
+download-request, download-search, download-retrieve and download-order-remove) on synthetic
+scenes, and serves their files with HEAD, Range and If-Range support. The files are generated
+chunk by chunk, so their size does not change the memory of the server. Latency, error rate,
+preparation delay and bandwidth are configurable:
+
+    with MockServer(scenes=1000, latency=.05, errorRate=.01, prepDelay=2.) as server:
+        api.M2M_ENDPOINT = server.endpoint
+        m2m = M2M('username', 'password')
+
+MockProcess takes the same options and runs the server in a separate process, so it does not
+count in the memory and CPU of the client being measured. It can also be run standalone:
+
+    python tests/mock_server.py --port 8080
+"""
+import argparse
+import hashlib
+import json
+import random
+import re
+import socketserver
+import subprocess
+import sys
+import threading
+import time
+import http.server
+import os.path as osp
+import urllib.request
+
+datasets = ['landsat_ot_c2_l1', 'landsat_ot_c2_l2']
+block_size = 64 * 1024
+
+def scene(k):
+    """
+    Synthetic scene number k, the footprints of consecutive scenes form a grid over California.
+    """
+    lon = -125. + (k % 20) * .6
+    lat = 32. + (k // 20 % 20) * .5
+    day = 1 + k % 28
+    return {
+        'entityId': 'E{:07d}'.format(k),
+        'displayId': 'LC08_L1TP_{:07d}'.format(k),
+        'cloudCover': str(k * 37 % 100),
+        'temporalCoverage': {'startDate': '2020-08-{:02d} 00:00:00'.format(day), 'endDate': '2020-08-{:02d} 00:00:00'.format(day)},
+        'spatialBounds': {'type': 'Polygon', 'coordinates': [[[lon, lat], [lon + 1, lat], [lon + 1, lat + 1], [lon, lat + 1], [lon, lat]]]},
+        'metadata': []
+    }
+
+def content(name, start, end):
+    """
+    Bytes from start to end (excluded) of the synthetic file name, its MD5 digest repeated.
+    """
+    seed = hashlib.md5(name.encode()).digest()
+    shift = start % len(seed)
+    seed = seed[shift:] + seed[:shift]
+    return (seed * ((end - start) // len(seed) + 1))[:end - start]
+
+def download(port, downloadId):
+    return {'downloadId': downloadId,
+            'url': 'http://127.0.0.1:{}/files/{}.tar'.format(port, scene(downloadId)['displayId'])}
+
+class MockServer(object):
+
+    def __init__(self, port=0, scenes=1000, fileSize=1024*1024, latency=0., jitter=0., errorRate=0.,
+                 prepDelay=0., bandwidth=None, keyTTL=None, resultLatency=0., seed=0):
+        """
+        :param port: port of the server, a free one by default
+        :param scenes: number of synthetic scenes of every dataset
+        :param fileSize: size in bytes of the file of every scene
+        :param latency: seconds added to every M2M request
+        :param jitter: maximum random seconds added to latency
+        :param errorRate: fraction of the M2M requests answered with a throttling error (HTTP 429)
+        :param prepDelay: maximum seconds until a requested download is available
+        :param bandwidth: maximum bytes per second of every file transfer, unlimited by default
+        :param keyTTL: seconds an API key is valid, requests with other keys are rejected with
+            AUTH_KEY_INVALID, API keys are not checked by default
+        :param resultLatency: seconds added to scene-search for every scene returned
+        :param seed: seed of the random generator
+        """
+        self.nScenes = scenes
+        self.fileSize = fileSize
+        self.latency = latency
+        self.jitter = jitter
+        self.errorRate = errorRate
+        self.prepDelay = prepDelay
+        self.bandwidth = bandwidth
+        self.keyTTL = keyTTL
+        self.resultLatency = resultLatency
+        self.keys = {}
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.lists = {}
+        self.orders = {}
+        self.counts = {}
+        self.scenes = [scene(k) for k in range(scenes)]
+        self.server = ThreadingServer(('127.0.0.1', port), Handler)
+        self.server.mock = self
+        self.port = self.server.server_address[1]
+        self.thread = None
+
+    @property
+    def endpoint(self):
+        """
+        Endpoint template to use as api.M2M_ENDPOINT.
+        """
+        return 'http://127.0.0.1:{}/api/{{}}/'.format(self.port)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def requestCounts(self):
+        with self.lock:
+            return dict(self.counts)
+
+    def delay(self):
+        seconds = self.latency + self.random.random() * self.jitter
+        if seconds > 0:
+            time.sleep(seconds)
+
+    def handle(self, endpoint, request):
+        """
+        Answer an M2M request.
+
+        :return: the data of the response
+        """
+        with self.lock:
+            self.counts[endpoint] = self.counts.get(endpoint, 0) + 1
+        if endpoint in ('login', 'login-token'):
+            with self.lock:
+                apiKey = 'API-KEY-{}-{}'.format(request.get('username'), len(self.keys))
+                self.keys[apiKey] = time.time()
+            return apiKey
+        if endpoint == 'logout':
+            return None
+        if endpoint == 'dataset-search':
+            return [{'datasetAlias': name} for name in datasets]
+        if endpoint == 'permissions':
+            return ['user', 'download', 'order']
+        if endpoint == 'dataset-filters':
+            return [{'id': 'f{}'.format(k), 'fieldLabel': label} for k,label in
+                    enumerate(['Sensor Identifier', 'Data Type L1', 'Collection Category'])]
+        if endpoint == 'scene-search':
+            return self.sceneSearch(request)
+        if endpoint == 'scene-list-add':
+            entityIds = request.get('entityIds') or [request.get('entityId')]
+            with self.lock:
+                sceneList = self.lists.setdefault(request['listId'], {})
+                sceneList.update(dict.fromkeys(entityIds))
+            return len(entityIds)
+        if endpoint == 'scene-list-remove':
+            with self.lock:
+                self.lists.pop(request['listId'], None)
+            return None
+        if endpoint == 'download-options':
+            with self.lock:
+                entityIds = list(self.lists.get(request.get('listId'), {})) or request.get('entityIds', [])
+            return [{'id': 'P' + entityId, 'entityId': entityId, 'available': True, 'downloadSystem': 'dds'}
+                    for entityId in entityIds]
+        if endpoint == 'download-request':
+            return self.downloadRequest(request)
+        if endpoint == 'download-search':
+            with self.lock:
+                order = dict(self.orders.get(request.get('label'), {}))
+            return [{'downloadId': downloadId, 'displayId': self.scenes[downloadId]['displayId'],
+                     'entityId': self.scenes[downloadId]['entityId']} for downloadId in order]
+        if endpoint == 'download-retrieve':
+            now = time.time()
+            with self.lock:
+                order = dict(self.orders.get(request.get('label'), {}))
+            available = [self.download(downloadId) for downloadId,ready in order.items() if ready <= now]
+            requested = [{'downloadId': downloadId, 'url': None} for downloadId,ready in order.items() if ready > now]
+            return {'available': available, 'requested': requested, 'queueSize': len(requested)}
+        if endpoint == 'download-order-remove':
+            with self.lock:
+                self.orders.pop(request.get('label'), None)
+            return None
+        raise KeyError(endpoint)
+
+    def validKey(self, apiKey):
+        with self.lock:
+            issued = self.keys.get(apiKey)
+        return self.keyTTL is None or (issued is not None and time.time() - issued < self.keyTTL)
+
+    def sceneSearch(self, request):
+        sceneFilter = request.get('sceneFilter', {})
+        results = self.scenes
+        acquisitionFilter = sceneFilter.get('acquisitionFilter')
+        if acquisitionFilter:
+            results = [scene for scene in results
+                       if acquisitionFilter['start'] <= scene['temporalCoverage']['startDate'][:10] <= acquisitionFilter['end']]
+        spatialFilter = sceneFilter.get('spatialFilter')
+        if spatialFilter and spatialFilter.get('filterType') == 'mbr':
+            ll, ur = spatialFilter['lowerLeft'], spatialFilter['upperRight']
+            results = [scene for scene in results
+                       if ll['longitude'] <= scene['spatialBounds']['coordinates'][0][0][0] < ur['longitude']
+                       and ll['latitude'] <= scene['spatialBounds']['coordinates'][0][0][1] < ur['latitude']]
+        start = request.get('startingNumber', 1)
+        page = results[start - 1:start - 1 + request.get('maxResults', 100)]
+        nextRecord = start + len(page) if start - 1 + len(page) < len(results) else None
+        if self.resultLatency:
+            time.sleep(len(page) * self.resultLatency)
+        return {'results': page, 'recordsReturned': len(page), 'totalHits': len(results),
+                'startingNumber': start, 'nextRecord': nextRecord}
+
+    def downloadRequest(self, request):
+        now = time.time()
+        duplicates = {}
+        newRecords = {}
+        with self.lock:
+            order = self.orders.setdefault(request['label'], {})
+            for download in request['downloads']:
+                downloadId = int(download['entityId'][1:])
+                for label,other in self.orders.items():
+                    if label != request['label'] and downloadId in other:
+                        duplicates[download['productId']] = label
+                        break
+                else:
+                    if downloadId not in order:
+                        newRecords[str(downloadId)] = request['label']
+                    order.setdefault(downloadId, now + self.random.random() * self.prepDelay)
+            preparing = [{'downloadId': downloadId} for downloadId,ready in order.items() if ready > now]
+            available = [self.download(downloadId) for downloadId,ready in order.items() if ready <= now]
+        # like M2M, empty duplicateProducts and newRecords are lists instead of dictionaries
+        return {'availableDownloads': available, 'duplicateProducts': duplicates or [],
+                'preparingDownloads': preparing, 'failed': [], 'newRecords': newRecords or []}
+
+    def download(self, downloadId):
+        return download(self.port, downloadId)
+
+class MockProcess(object):
+    """
+    MockServer running in a separate process, with the same options and interface.
+    """
+
+    flags = {'scenes': '--scenes', 'fileSize': '--file-size', 'latency': '--latency', 'jitter': '--jitter',
+             'errorRate': '--error-rate', 'prepDelay': '--prep-delay', 'bandwidth': '--bandwidth',
+             'keyTTL': '--key-ttl', 'resultLatency': '--result-latency', 'seed': '--seed'}
+
+    def __init__(self, port=0, **options):
+        """
+        :param port: port of the server, a free one by default
+        :param options: options of MockServer
+        """
+        self.args = [sys.executable, osp.abspath(__file__), '--port', str(port)]
+        for key,value in options.items():
+            if value is not None:
+                self.args += [self.flags[key], str(value)]
+        self.process = None
+        self.port = None
+
+    @property
+    def endpoint(self):
+        return 'http://127.0.0.1:{}/api/{{}}/'.format(self.port)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def start(self):
+        self.process = subprocess.Popen(self.args, stdout=subprocess.PIPE, universal_newlines=True)
+        line = self.process.stdout.readline()
+        match = re.search(r':(\d+)/', line)
+        if match is None:
+            self.stop()
+            raise RuntimeError('mock server did not start: {}'.format(line))
+        self.port = int(match.group(1))
+
+    def stop(self):
+        self.process.terminate()
+        self.process.wait()
+        self.process.stdout.close()
+
+    def requestCounts(self):
+        with urllib.request.urlopen('http://127.0.0.1:{}/counts'.format(self.port)) as r:
+            return json.load(r)
+
+    def download(self, downloadId):
+        return download(self.port, downloadId)
+
+class ThreadingServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # headers and body are written separately, Nagle's algorithm would delay keep-alive responses
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, data, status=200, errorCode=None, errorMessage=None, headers={}):
+        body = json.dumps({'data': data, 'errorCode': errorCode, 'errorMessage': errorMessage}).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for key,value in headers.items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        mock = self.server.mock
+        endpoint = self.path.rstrip('/').split('/')[-1]
+        length = int(self.headers.get('Content-Length', 0))
+        request = json.loads(self.rfile.read(length) or b'{}')
+        mock.delay()
+        if mock.errorRate and mock.random.random() < mock.errorRate:
+            return self.reply(None, 429, 'RATE_LIMIT', 'Too many requests', {'Retry-After': '0.1'})
+        if endpoint not in ('login', 'login-token') and not mock.validKey(self.headers.get('X-Auth-Token')):
+            return self.reply(None, 401, 'AUTH_KEY_INVALID', 'Invalid API key')
+        try:
+            data = mock.handle(endpoint, request)
+        except KeyError:
+            return self.reply(None, 404, 'UNKNOWN', 'Unknown endpoint {}'.format(endpoint))
+        self.reply(data)
+
+    def do_GET(self):
+        if self.path == '/counts':
+            body = json.dumps(self.server.mock.requestCounts()).encode()
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        self.serve(True)
+
+    def do_HEAD(self):
+        self.serve(False)
+
+    def serve(self, body):
+        mock = self.server.mock
+        name = self.path.split('/')[-1].split('?')[0]
+        size = mock.fileSize
+        etag = '"{}"'.format(hashlib.md5(name.encode()).hexdigest())
+        start, end, status = 0, size - 1, 200
+        match = re.match(r'bytes=(\d+)-(\d*)', self.headers.get('Range') or '')
+        if match and self.headers.get('If-Range', etag) == etag:
+            start = int(match.group(1))
+            end = int(match.group(2)) if match.group(2) else size - 1
+            status = 206
+        self.send_response(status)
+        self.send_header('Content-Length', str(end - start + 1))
+        self.send_header('ETag', etag)
+        self.send_header('Accept-Ranges', 'bytes')
+        if status == 206:
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, end, size))
+        self.end_headers()
+        if not body:
+            return
+        begin = time.monotonic()
+        for offset in range(start, end + 1, block_size):
+            self.wfile.write(content(name, offset, min(offset + block_size, end + 1)))
+            if mock.bandwidth:
+                wait = (offset + block_size - start) / mock.bandwidth - (time.monotonic() - begin)
+                if wait > 0:
+                    time.sleep(wait)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Mock M2M USGS API server')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--scenes', type=int, default=1000)
+    parser.add_argument('--file-size', type=int, default=1024*1024)
+    parser.add_argument('--latency', type=float, default=0.)
+    parser.add_argument('--jitter', type=float, default=0.)
+    parser.add_argument('--error-rate', type=float, default=0.)
+    parser.add_argument('--prep-delay', type=float, default=0.)
+    parser.add_argument('--bandwidth', type=float, default=None)
+    parser.add_argument('--key-ttl', type=float, default=None)
+    parser.add_argument('--result-latency', type=float, default=0.)
+    parser.add_argument('--seed', type=int, default=0)
+    options = parser.parse_args()
+    server = MockServer(options.port, options.scenes, options.file_size, options.latency, options.jitter,
+                        options.error_rate, options.prep_delay, options.bandwidth, options.key_ttl,
+                        options.result_latency, options.seed)
+    print('Mock M2M USGS API at {}'.format(server.endpoint.format('stable')), flush=True)
+    server.server.serve_forever()
@@ -0,0 +1,110 @@
+import logging
+import threading
+import time
+
+class RateLimiter(object):
+    """
+    Thread-safe token bucket limiting the rate of requests.
+
+    The same RateLimiter can be shared by several M2M objects to limit the requests of a process.
+    """
+
+    def __init__(self, rate, burst=1):
+        """
+        :param rate: tokens added to the bucket every second
+        :param burst: maximum number of tokens in the bucket
+        """
+        self.rate = float(rate)
+        self.burst = max(1., float(burst))
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.resumeTime = 0.
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Wait until a token is available and take it.
+        """
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if now >= self.resumeTime and self.tokens >= 1.:
+                    self.tokens -= 1.
+                    return
+                wait = max(self.resumeTime - now, (1. - self.tokens) / self.rate)
+            time.sleep(wait)
+
+    def backoff(self, seconds):
+        """
+        Stop giving tokens during some seconds, used when the server throttles the requests.
+        """
+        with self.lock:
+            self.resumeTime = max(self.resumeTime, time.monotonic() + seconds)
+            self.tokens = 0.
+
+class ConcurrencyController(object):
+    """
+    Additive increase, multiplicative decrease (AIMD) limit of concurrent tasks.
+
+    The limit increases by one while the throughput measured every window seconds improves,
+    decreases by one when the throughput drops and halves when a task fails.
+    """
+
+    def __init__(self, initial=4, minimum=1, maximum=10, window=10.):
+        """
+        :param initial: initial limit of concurrent tasks
+        :param minimum: minimum limit of concurrent tasks
+        :param maximum: maximum limit of concurrent tasks
+        :param window: seconds between throughput measures
+        """
+        self.minimum = minimum
+        self.maximum = maximum
+        self.limit = max(minimum, min(initial, maximum))
+        self.window = window
+        self.active = 0
+        self.windowBytes = 0
+        self.windowStart = time.monotonic()
+        self.throughput = None
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        """
+        Wait until the number of active tasks is under the limit and start a task.
+        """
+        with self.condition:
+            while self.active >= self.limit:
+                self.condition.wait()
+            self.active += 1
+
+    def release(self, nbytes=0, error=False):
+        """
+        Finish a task, updating the limit from its result.
+
+        :param nbytes: bytes transferred by the task
+        :param error: True if the task failed
+        """
+        with self.condition:
+            self.active -= 1
+            if error:
+                self.limit = max(self.minimum, self.limit // 2)
+                self.resetWindow()
+                logging.info('ConcurrencyController.release - error, limit decreased to {}'.format(self.limit))
+            else:
+                self.windowBytes += nbytes
+                elapsed = time.monotonic() - self.windowStart
+                if elapsed >= self.window:
+                    throughput = self.windowBytes / elapsed
+                    if self.throughput is None or throughput > 1.05 * self.throughput:
+                        self.limit = min(self.maximum, self.limit + 1)
+                    elif throughput < .8 * self.throughput:
+                        self.limit = max(self.minimum, self.limit - 1)
+                    logging.info('ConcurrencyController.release - throughput {:.0f} B/s, limit {}'.format(throughput, self.limit))
+                    self.throughput = throughput
+                    self.resetWindow()
+            self.condition.notify_all()
+
+    def resetWindow(self):
+        self.windowBytes = 0
+        self.windowStart = time.monotonic()